@@ -31,16 +31,26 @@ jcf.save(new_file)
 '''
 
 
+import collections
 import json
+import heapq
+import marshal
+import re
 from os.path import isfile, dirname, basename, join, abspath
 from pprint import pprint, pformat
-from copy import copy, deepcopy
-import re
+from copy import deepcopy
 import random
 import time
 import logging
+import sys
+import Queue
+from multiprocessing.pool import ThreadPool
 
 from .. import util
+from . import ckey_template
+from . import interpolate
+from . import jsonio
+from .cache import include_cache, local_address, file_signature, abspath_key
 
 
 # Custom exceptions used internally for this class
@@ -49,6 +59,357 @@ class FlowError(Exception):
         self.message = message
 
 
+class NameAllocator(object):
+    '''
+    Hands out unique names by appending "_2", "_3", etc. to a base name.
+
+    Keeps a count of every name in use and, per base name, the next suffix to
+    try, so allocating n names is linear rather than rescanning the list of
+    names for every candidate.
+    '''
+
+    def __init__(self, names=()):
+        # name -> number of holders
+        self.used = dict()
+        # base name -> next suffix to try
+        self.next_suffix = dict()
+        for n in names:
+            self.claim(n)
+
+    def __contains__(self, name):
+        return name in self.used
+
+    def count(self, name):
+        return self.used.get(name, 0)
+
+    def claim(self, name):
+        self.used[name] = self.used.get(name, 0) + 1
+
+    def release(self, name):
+        c = self.used.get(name, 0)
+        if c > 1:
+            self.used[name] = c - 1
+        elif c:
+            del self.used[name]
+
+    def allocate(self, base, start=2):
+        '''
+        Claims and returns (name, suffix) for the first unused
+        base + "_" + suffix, trying suffixes from start upwards
+        '''
+        i = max(self.next_suffix.get(base, start), start)
+        name = base + "_" + str(i)
+        while name in self.used:
+            i += 1
+            name = base + "_" + str(i)
+        self.next_suffix[base] = i + 1
+        self.claim(name)
+        return name, i
+
+
+class ReferenceIndex(object):
+    '''
+    Index of the places within a JCF that refer to stages and suts by name:
+    - strings containing ${stages.<name>...} or ${suts.<name>...} variables
+      (with something after the name, ${suts.<name>} is not renamed)
+    - stage flow controls (next_*) naming a stage
+    - stage targets naming a sut
+
+    The index is built with a single walk over the JCF so that any number of
+    stages and suts can be renamed afterwards by touching only the places
+    that mention them.
+    '''
+
+    def __init__(self, jcf):
+        # (section, name) -> list of (container, key) holding a string
+        self.variables = dict()
+        # stage name -> list of (stage data, flow control)
+        self.flow_controls = dict()
+        # sut name -> list of stage data
+        self.targets = dict()
+
+        self._index_strings(jcf.get_dict())
+        if isinstance(jcf.stages, dict):
+            for v in jcf.stages.values():
+                for fc in jcf.flow_controls:
+                    if v.get(fc):
+                        self.flow_controls.setdefault(v[fc], []).append((v, fc))
+                if v.get("target"):
+                    self.targets.setdefault(v["target"], []).append(v)
+
+    def _index_strings(self, structure):
+        if isinstance(structure, dict):
+            items = structure.items()
+        elif isinstance(structure, list):
+            items = enumerate(structure)
+        else:
+            return
+
+        for k, v in items:
+            if isinstance(v, str) or isinstance(v, unicode):
+                if "${stages." not in v and "${suts." not in v:
+                    continue
+                for variable in interpolate.compile_template(v).variables:
+                    path = variable.path
+                    if len(path) > 1 and path[0] in ("stages", "suts"):
+                        self.variables.setdefault((path[0], path[1]), []).append(
+                            (structure, k))
+            elif isinstance(v, dict) or isinstance(v, list):
+                self._index_strings(v)
+
+    def rename(self, suts=None, stages=None):
+        '''
+        Applies renames given as dicts of old name -> new name
+        '''
+        renames = {
+            "suts": suts or {},
+            "stages": stages or {}
+        }
+
+        # Strings, each one is rewritten once even if it refers to several
+        # renamed objects
+        leaves = dict()
+        for section, names in renames.items():
+            for n in names:
+                for container, k in self.variables.get((section, n), []):
+                    leaves[(id(container), k)] = (container, k)
+        for container, k in leaves.values():
+            container[k] = self._rename_string(container[k], renames)
+
+        for n, new_name in renames["stages"].items():
+            for v, fc in self.flow_controls.get(n, []):
+                if v[fc] == n:
+                    v[fc] = new_name
+
+        for n, new_name in renames["suts"].items():
+            for v in self.targets.get(n, []):
+                if v["target"] == n:
+                    v["target"] = new_name
+
+    def _rename_string(self, string, renames):
+        parts = list()
+        for segment in interpolate.compile_template(string).segments:
+            if isinstance(segment, interpolate.Variable):
+                path = segment.path
+                rest = None
+                if len(path) > 1 and path[0] in renames and \
+                        path[1] in renames[path[0]]:
+                    rest = segment.key[len(path[0]) + 1 + len(path[1]):]
+                # Replace only the name, keeping any [#] or .key after it.
+                # References to a whole sut or stage (nothing after the name)
+                # have never been renamed and are left as they are.
+                if rest:
+                    segment = "${" + path[0] + "." + \
+                        renames[path[0]][path[1]] + rest + "}"
+                else:
+                    segment = segment.text
+            parts.append(segment)
+        return "".join(parts)
+
+
+class FlowGraph(object):
+    '''
+    Flow control graph of a stages dict.
+
+    successors and predecessors hold every flow control (next_*) edge so the
+    stage before or after any stage is found without walking the flow. Paths
+    along flow controls are walked once per (path, start stage) and kept.
+
+    The graph reflects the flow of the stages at the time it was built, see
+    JCF.get_flow_graph() for the cached graph of a JCF.
+
+    stages        = dict of stage name -> stage data
+    flow_controls = flow control keys that make up the edges
+    '''
+
+    def __init__(self, stages, flow_controls):
+        self.stages = stages
+        self.flow_controls = flow_controls
+        # stage name -> dict of flow control -> target
+        self.successors = dict()
+        # target -> list of (stage name, flow control) pointing to it
+        self.predecessors = dict()
+        # stage name -> number of stages whose main flow (next_pass or
+        # else next_default) leads to it
+        self.in_degree = dict()
+        # (path, start stage) -> (ordered stages, other stages)
+        self._paths = dict()
+        self._first_stage = None
+
+        for id, v in stages.items():
+            edges = dict()
+            for fc in flow_controls:
+                target = v.get(fc)
+                if target:
+                    edges[fc] = target
+                    self.predecessors.setdefault(target, []).append((id, fc))
+            self.successors[id] = edges
+
+            if "next_pass" in v:
+                target = v["next_pass"]
+            elif "next_default" in v:
+                target = v["next_default"]
+            else:
+                continue
+            if target in stages:
+                self.in_degree[target] = self.in_degree.get(target, 0) + 1
+
+    def next_stage(self, stage, path="next_default"):
+        '''
+        Returns the name of the stage that follows stage on path or None if
+        the flow ends there. Falls back to next_default if stage has no
+        (or a "_next") setting for path, same as the path walk.
+        '''
+        if stage not in self.stages:
+            return None
+        if path in self.flow_controls:
+            next_stage = self.successors[stage].get(path, "_next")
+        else:
+            next_stage = self.stages[stage].get(path, "_next")
+        if not next_stage or next_stage == "_next":
+            next_stage = self.successors[stage].get("next_default")
+        if next_stage in self.stages:
+            return next_stage
+        return None
+
+    def previous_stages(self, stage):
+        '''
+        Returns a list of (stage name, flow control) of the stages that lead
+        to stage
+        '''
+        return list(self.predecessors.get(stage, []))
+
+    def first_stage(self):
+        '''
+        Returns the stage that nothing else points to.
+
+        Exceptions:
+            ValueError if there isn't exactly one such stage
+        '''
+        if self._first_stage is not None:
+            return self._first_stage
+
+        stage_dict = self.stages
+        # The first stage is detected by looking for the one stage that won't
+        # have anything else pointing to it. This approach will work with
+        # most cases. Anything else is a configuration error.
+        # A stage with order 1 takes precedence.
+        all_stages = None
+        for id, v in stage_dict.items():
+            if "order" in v and v["order"] is 1:
+                all_stages = [id]
+                break
+
+        if all_stages is None:
+            all_stages = [id for id in stage_dict
+                          if not self.in_degree.get(id)]
+
+        if len(all_stages) != 1:
+            err = "Cannot figure out initial stage from subset" + \
+                  " " + str(sorted(stage_dict.keys())) + "."
+            if len(all_stages) > 1:
+                err += " Ambiguous candidates: " + str(sorted(all_stages))
+            else:
+                err += " No candidates. Possible illegal stage loop."
+            err += " You could use 'init_stage' setting to resolve this."
+            raise ValueError(err)
+
+        # Found the most likely initial stage
+        self._first_stage = all_stages[0]
+        return self._first_stage
+
+    def path(self, path, start):
+        '''
+        Returns a tuple of lists (ordered, other) of (stage name, stage data):
+        the stages visited following path from start and the remaining
+        stages sorted by name. Walks along flow controls are kept. Other
+        paths are read from stage data that is not part of the graph, those
+        are walked every time.
+        '''
+        key = (path, start)
+        result = self._paths.get(key)
+        if result is None:
+            ordered_stages = list()
+            visited_stages = dict()
+            s = start
+            while s in self.stages and s not in visited_stages:
+                # If stage is encountered twice we are in a loop, quit now
+                ordered_stages.append((s, self.stages[s]))
+                visited_stages[s] = True
+                s = self.next_stage(s, path)
+
+            # Calculate standalone stages
+            unordered_stages = [(id, self.stages[id])
+                                for id in sorted(self.stages.keys())
+                                if id not in visited_stages]
+            result = (ordered_stages, unordered_stages)
+            if path in self.flow_controls:
+                self._paths[key] = result
+
+        return list(result[0]), list(result[1])
+
+
+class CkeyView(collections.Mapping):
+    '''
+    Read-only mapping of local ckeys over global ckeys, see
+    JCF.get_ckey_view()
+    '''
+
+    def __init__(self, local, ckey):
+        self.local = local
+        self.ckey = ckey
+
+    def __getitem__(self, key):
+        if key in self.local:
+            return self.local[key]
+        return self.ckey[key]
+
+    def __contains__(self, key):
+        return key in self.local or key in self.ckey
+
+    def __iter__(self):
+        for k in self.local:
+            yield k
+        for k in self.ckey:
+            if k not in self.local:
+                yield k
+
+    def __len__(self):
+        n = len(self.local)
+        for k in self.ckey:
+            if k not in self.local:
+                n += 1
+        return n
+
+    def __repr__(self):
+        return "CkeyView(" + repr(dict(self.items())) + ")"
+
+
+class CkeySnapshot(collections.Mapping):
+    '''
+    Read-only copy of ckey values taken at one point in time, see
+    JCF.get_ckey_snapshot(). Later changes to the JCF do not show up in it.
+    '''
+
+    def __init__(self, values):
+        self._values = values
+
+    def __getitem__(self, key):
+        return self._values[key]
+
+    def __contains__(self, key):
+        return key in self._values
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __repr__(self):
+        return "CkeySnapshot(" + repr(self._values) + ")"
+
+
 class JCF(object):
     # Sections - this list contains all sections (class members) that should be
     # exported to JSON, it also serves to check if any of these keys are not
@@ -77,6 +438,25 @@ class JCF(object):
         "job_group"
     ]
 
+    # Value of each section when it is missing from the JCF, sections not
+    # listed here default to None
+    section_defaults = {
+        "info": dict,
+        "tags": list,
+        "include": dict,
+        "included": list,
+        "local": dict,
+        "suts": dict,
+        "stages": dict,
+        "ckey": dict,
+        "local_ckey": dict,
+        "ckey_template": dict,
+        "module_info": dict,
+        "dynamic": dict,
+        "is_global": dict,
+        "job_group": list
+    }
+
     # Flow Controls - this is a list of all valid flow controls
     flow_controls = [
         "next_default",
@@ -91,9 +471,15 @@ class JCF(object):
         "_quit"
     ]
 
-    def __init__(self, json_src={}, max_depth=100, serial=None, default_owner=None):
+    def __init__(self, json_src={}, max_depth=100, serial=None, default_owner=None,
+                 cached=False):
         # Internal
         self._raw = None
+        # Sections loaded on first access: section name -> name of the
+        # method that loads it, see LazyJCF
+        self._deferred = dict()
+        # Sections still in _raw must be copied before they are used
+        self._borrowed = False
         self._serial = serial
         self.auto_init_stage = None
 
@@ -125,22 +511,34 @@ class JCF(object):
         self.max_depth = max_depth
         self.order = 1
         self.interpolation_errors = list()
+        self._interpolation_tracker = None
+        self._prefetched = None
+        # Stage bookkeeping, see get_flow_graph() and process_stages()
+        self._flow_graph = None
+        self._stages_processed = None
+        # ckey name -> scope index, see get_scope() and local_changed()
+        self._scope_index = None
         self.default_name = "cirrus_job"
 
         if isinstance(json_src, dict):
             # Preparsed JSON
-            raw = deepcopy(json_src)
+            raw = self._copy_source(json_src)
         elif isinstance(json_src, list):
             # Lines from a file
             # Combine into single string and then make into JSON
             json_src = "\n".join(json_src)
-            raw = util.read_json_str(json_src)
+            raw = jsonio.read_json_str(json_src)
         else:
             # A file name
             # This will search for the file and add the .json suffix if needed
             self.path = util.retrieve_file(json_src, exts=[".json"])
 
-            raw = util.read_json(self.path)
+            # Shared library files (includes) come from the process-wide
+            # cache, see cache.py
+            if cached:
+                raw = include_cache.get(self.path)
+            else:
+                raw = jsonio.read_json(self.path)
 
         # Create a default name
         if self.path:
@@ -151,29 +549,7 @@ class JCF(object):
             default_name = self.default_name
 
         # Set defaults for all members
-        self.info = raw.get("info", dict())
-        self.init_stage = raw.get("init_stage", None)
-        self.tags = raw.get("tags", [])
-        self.include = raw.get("include", {})
-        self.included = raw.get("included", [])
-        self.local = raw.get("local", dict())
-        self.tags = raw.get("tags", [])
-        self.suts = raw.get("suts", dict())
-        self.stages = raw.get("stages", {})
-        self.ckey = raw.get("ckey", dict())
-        self.local_ckey = raw.get("local_ckey", dict())
-        self.ckey_template = raw.get("ckey_template", dict())
-        self.module_info = raw.get("module_info", dict())
-        self.dynamic = raw.get("dynamic", dict())
-        self.origination = raw.get("origination", None)
-        self.job_timeout = raw.get("job_timeout", None)
-        self.configure = raw.get("configure", None)
-        self.optionTextMap = raw.get("optionTextMap", None)
-        self.include_options = raw.get("include_options", None)
-        self.id = raw.get("id", None)
-        self.job_group = raw.get("job_group", [])
-        self._raw = raw
-        self.is_global = raw.get("is_global", dict())
+        self._load_sections(raw)
 
         # Import or create serial
         if "info" in raw and "_serial" in raw["info"]:
@@ -226,6 +602,50 @@ class JCF(object):
         # Extract template names from includes. Do not do this recursively
         # because at this time we just want to know if the immediate descendants
         # are templates or not.
+        self._find_templates()
+
+        # Set origination for this JCF--the local IP
+        # TODO: this will work for current activities which mainly validate that
+        # the current system is the one we think it is for stage execution
+        # (code in agent.py) but this needs to be refined to identify primary
+        # IPs in multi-homed hosts.
+        # See also: sys_cirrus setting
+        if not self.origination:
+            self.origination = unicode(local_address.get())
+
+        # Propagate serial numbers to stages
+        self._propagate_serial()
+
+    def _copy_source(self, json_src):
+        '''
+        Returns the copy of pre-parsed JSON that the JCF works on
+        '''
+        return deepcopy(json_src)
+
+    def _section(self, raw, name):
+        '''
+        Returns section name from raw or its default if it is not present
+        '''
+        if name in raw:
+            return raw[name]
+        default = self.section_defaults.get(name)
+        if default is None:
+            return None
+        return default()
+
+    def _load_sections(self, raw):
+        '''
+        Sets the section members from raw
+        '''
+        for name in self.section_members:
+            setattr(self, name, self._section(raw, name))
+        self._raw = raw
+
+    def _find_templates(self):
+        '''
+        Fills templates with the immediate includes that are tagged as
+        templates
+        '''
         if self.include:
             if self.path:
                 include_paths = [dirname(self.path), "."]
@@ -246,30 +666,27 @@ class JCF(object):
                         else:
                             raise ValueError("include structure is missing 'id' field")
 
-                    # Create temporary JCF object, depth to 0 to avoid
-                    # recursion
+                    # Only the tags are needed so look at the parsed file
+                    # rather than building a JCF object. The parse is
+                    # reused when process_includes() loads the include.
                     try:
                         local_file = util.retrieve_file(include_file,
                                                         include_paths,
                                                         [".json"],
                                                         remote=False)
-                        included_jcf = JCF(local_file, max_depth=0)
-                        if "template" in included_jcf.tags:
-                            self.templates.append(included_jcf.path)
-                    except ValueError, IOError:
-                        # Skip any that we cannot read
+                        included = include_cache.get(local_file)
+                        if isinstance(included, dict) and \
+                                "template" in included.get("tags", []):
+                            self.templates.append(local_file)
+                    except ValueError:
+                        # Skip any that we cannot parse, a missing include
+                        # is raised here as it always was
                         pass
 
-        # Set origination for this JCF--the local IP
-        # TODO: this will work for current activities which mainly validate that
-        # the current system is the one we think it is for stage execution
-        # (code in agent.py) but this needs to be refined to identify primary
-        # IPs in multi-homed hosts.
-        # See also: sys_cirrus setting
-        if not self.origination:
-            self.origination = unicode(util.get_preferred_local_ip())
-
-        # Propagate serial numbers to stages
+    def _propagate_serial(self):
+        '''
+        Sets the serial number of this JCF on stages that do not have one
+        '''
         stage_list = list()
         if isinstance(self.stages, dict):
             stage_list = self.stages.values()
@@ -346,13 +763,16 @@ class JCF(object):
                                                 data.get("next_fail", "-"),
                                                 data.get("next_default", "-"))
 
-    def process(self, recursive=True):
+    def process(self, recursive=True, workers=None):
         '''
         Process all elements of a JCF so that it is in it's final form
+
+        workers = number of threads used to retrieve includes, see
+                  process_includes()
         '''
 
         self.process_stages()
-        self.process_includes()
+        self.process_includes(workers=workers)
         self.process_stages()
         self.process_system_vars()
         self.process_file_vars()
@@ -364,23 +784,179 @@ class JCF(object):
         self.process_system_vars()
 
         # Create modified job control file in working area
+        new_jcf = self._stage_jcf_path(filename)
+        self.write(new_jcf)
+
+        # Update path
+        self.path = new_jcf
+
+    def create_stage_specific_jcf_files(self, filenames, workers=8):
+        '''
+        Writes the stage specific JCF of many stages in one go. Each file has
+        the same content create_stage_specific_jcf_file() would write for the
+        stage, but this JCF is left unchanged.
+
+        The content of a stage specific JCF only depends on the scope of the
+        stage (the serial of the file it came from), and within that only on
+        the local ckeys of the scope that are used from outside of any
+        object with a serial (see _scope_ckey_names()). Stages whose scopes
+        have the same such local ckeys share one interpolated and serialized
+        JCF, which is copied to the files of all of them. Files are written
+        by a pool of threads.
+
+        filenames = dict of stage name -> file name; a full path or a path
+                    relative to the directory of this JCF's file
+        workers   = number of threads writing files
+
+        Returns a dict of stage name -> path of the file written
+
+        Exceptions:
+            ValueError if stages with different content map to the same file
+        '''
+        paths = dict()
+        scopes = dict()
+        for stage, filename in filenames.items():
+            paths[stage] = self._stage_jcf_path(filename)
+            s = None
+            if stage:
+                s = self.get_stage_by_name(stage)
+            if s and "_serial" in s:
+                scopes[stage] = s["_serial"]
+            else:
+                scopes[stage] = None
+
+        # Group the scopes by the local ckeys that matter, each group is
+        # interpolated once: list of (local ckeys, scope, paths)
+        names = self._scope_ckey_names()
+        groups = list()
+        scope_groups = dict()
+        for scope in set(scopes.values()):
+            overrides = dict()
+            if scope:
+                for k in names:
+                    value = self.get_local_ckey(k, scope)
+                    if value != None:
+                        overrides[k] = value
+            for group in groups:
+                if group[0] == overrides:
+                    break
+            else:
+                group = (overrides, scope, list())
+                groups.append(group)
+            scope_groups[scope] = group
+
+        # Files are written in parallel, each one must be written once
+        targets = dict()
+        for stage in sorted(paths.keys()):
+            key = abspath_key(paths[stage])
+            group = scope_groups[scopes[stage]]
+            if key in targets:
+                if targets[key][1] is not group:
+                    raise ValueError("Stages " + str(targets[key][0]) +
+                                     " and " + str(stage) + " would both " +
+                                     "write " + paths[stage])
+                continue
+            targets[key] = (stage, group)
+            group[2].append(paths[stage])
+
+        jobs = list()
+        for overrides, scope, group in groups:
+            if not group:
+                continue
+            stage_jcf = self.copy()
+            stage_jcf.interpolate_variables(scope=scope)
+            stage_jcf.process_system_vars()
+            jobs.append((stage_jcf, group))
+
+        def write(job):
+            stage_jcf, group = job
+            stage_jcf.write(group[0])
+
+        def copy_file(job):
+            jsonio.copy_file(job[0], job[1])
+
+        copies = [(group[0], path) for stage_jcf, group in jobs
+                  for path in group[1:]]
+
+        if workers > 1:
+            pool = ThreadPool(workers)
+            try:
+                pool.map(write, jobs)
+                pool.map(copy_file, copies)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            map(write, jobs)
+            map(copy_file, copies)
+
+        return paths
+
+    def _scope_ckey_names(self):
+        '''
+        Returns the set of ckey names whose local value can change what
+        interpolate_variables(scope=...) produces.
+
+        Strings within an object that has a serial (stages, info...) are
+        interpolated in the scope of that serial, only the other strings use
+        the given scope. The names are those of the ckey variables of these
+        strings and of the values they lead to, following every local value
+        a ckey variable could be redirected to.
+        '''
+        top = object()
+        leaves = list()
+        for s in ("suts", "stages", "ckey", "info"):
+            self._collect_templates(getattr(self, s), top, "", leaves, (s,))
+
+        pending = list()
+        for container, k, template, scope, location in leaves:
+            if scope is top:
+                pending.extend(template.variables)
+
+        names = set()
+        seen = set()
+        while pending:
+            variable = pending.pop()
+            if variable.key in seen:
+                continue
+            seen.add(variable.key)
+
+            paths = [variable.path]
+            if variable.ckey_name is not None:
+                names.add(variable.ckey_name)
+                if self.local:
+                    paths.extend([("local", scope) + variable.path[1:]
+                                  for scope in self.local])
+            for path in paths:
+                found, value = self._lookup_path(path)
+                if not found:
+                    continue
+                if isinstance(value, str) or isinstance(value, unicode):
+                    if "${" in value:
+                        pending.extend(
+                            interpolate.compile_template(value).variables)
+                else:
+                    values = list()
+                    self._collect_templates(value, None, "", values)
+                    for leaf in values:
+                        pending.extend(leaf[2].variables)
+
+        return names
+
+    def _stage_jcf_path(self, filename):
         # Accepts linux or windows or "c:\" type filenames
         if filename and (filename.startswith("/") or
                          filename.startswith("\\") or
                          (len(filename) > 1 and filename[1] == ":")):
-            new_jcf = filename
+            return filename
         elif self.path:
-            new_jcf = join(dirname(self.path), filename)
+            return join(dirname(self.path), filename)
         else:
             raise ValueError("filename must be a full path or JCF object " +
                              "must be created from a file originally so " +
                              "path member is set")
-        self.write(new_jcf)
-
-        # Update path
-        self.path = new_jcf
 
-    def process_includes(self, depth=0):
+    def process_includes(self, depth=0, workers=None):
         '''
         !!!!!!!!!!!!!!!!!!!!!!!!!!!!
         IF YOU CHANGE THIS METHOD BE
@@ -395,6 +971,31 @@ class JCF(object):
            -1 = process to infinite depth
             0 = do not process includes (makes this method a noop)
            >0 = process to the indicated depth
+
+        workers - if set to more than 1 the whole include tree is retrieved
+        and parsed up front using that many threads (see prefetch_includes()).
+        Merging still happens one include at a time in the usual order so the
+        result is the same as a sequential run.
+
+        >>> import json, os, shutil, tempfile
+        >>> tmp = tempfile.mkdtemp()
+        >>> def write(name, data):
+        ...     json.dump(data, open(os.path.join(tmp, name), "w"))
+        ...     return os.path.join(tmp, name)
+        >>> c = write("c.json", {"ckey": {"c": "C", "x": "c"}})
+        >>> a = write("a.json", {"include": [c], "ckey": {"a": "A", "x": "a"}})
+        >>> b = write("b.json", {"ckey": {"b": "B", "x": "b"},
+        ...                      "stages": {"s": {}}})
+        >>> top = write("top.json", {"include": [a, b], "ckey": {"x": "top"}})
+        >>> serial = JCF(top)
+        >>> serial.process_includes()
+        >>> sorted(serial.ckey.items())
+        [(u'a', u'A'), (u'b', u'B'), (u'c', u'C'), (u'x', u'top')]
+        >>> parallel = JCF(top)
+        >>> parallel.process_includes(workers=4)
+        >>> parallel.ckey == serial.ckey, list(parallel.stages)
+        (True, [u's'])
+        >>> shutil.rmtree(tmp)
         '''
 
         # TODO: detect circular includes or just rely on the max_depth setting?
@@ -406,6 +1007,11 @@ class JCF(object):
         if self.include is None:
             return
 
+        if workers > 1 and self._prefetched is None:
+            self.prefetch_includes(workers, depth)
+        prefetched = self._prefetched
+        self._prefetched = None
+
         all_serials = []
         if self.stages and type(self.stages) is dict:
             all_serials = [v["_serial"] for v in self.stages.values() if self.stages\
@@ -450,9 +1056,15 @@ class JCF(object):
                 if "status" in self.include[n]:
                     status = self.include[n]["status"]
 
-            local_file = util.retrieve_file(include_file, include_paths, [".json"])
-            merge_from = JCF(local_file,
-                             serial=serial)
+            if prefetched is not None and n in prefetched:
+                local_file, merge_from, error = prefetched[n]
+                if error:
+                    raise error[0], error[1], error[2]
+            else:
+                local_file = util.retrieve_file(include_file, include_paths, [".json"])
+                merge_from = JCF(local_file,
+                                 serial=serial,
+                                 cached=True)
             merge_from.process_stages()
 
             # Add to included with full path for reference purposes
@@ -474,9 +1086,10 @@ class JCF(object):
                 if last_stage_of_current and first_stage_of_merge:
                     last_stage_of_current[1]["next_default"] = \
                         first_stage_of_merge[0]
+                    self.stages_changed()
 
-            # Merge all sections
-            self.merge(merge_from)
+            # Merge all sections, merge_from is not used afterwards
+            self.merge(merge_from, disposable=True)
 
             # Add to included line for reference
             self.included = self.included + merge_from.included
@@ -487,12 +1100,115 @@ class JCF(object):
         # Empty include line to prevent future merging
         self.include = []
 
-    def merge(self, merge_from):
+    def prefetch_includes(self, workers=8, depth=0):
+        '''
+        Retrieves and parses every JCF in the include tree in parallel, using
+        a pool of workers threads. Each include is started as soon as the file
+        including it has been parsed, so the total time is close to that of
+        the slowest chain of includes rather than the sum of all of them.
+
+        The parsed JCFs are kept on their parent and picked up by
+        process_includes(), which merges them in the usual order. Errors are
+        raised by process_includes() when it reaches the failing include.
+
+        depth - depth of this JCF within the include tree, the same max_depth
+        rules as process_includes() apply.
+        '''
+        results = Queue.Queue()
+        pool = ThreadPool(workers)
+        outstanding = 0
+
+        def load(include_file, serial, include_paths):
+            try:
+                local_file = util.retrieve_file(include_file, include_paths,
+                                                [".json"])
+                return (local_file, JCF(local_file, serial=serial, cached=True),
+                        None)
+            except BaseException:
+                # Also KeyboardInterrupt and SystemExit, the pool only
+                # reports Exception and would never call done() otherwise
+                return None, None, sys.exc_info()
+
+        def submit(parent, parent_depth):
+            # Same conditions as process_includes()
+            if parent.max_depth != -1 and parent_depth >= parent.max_depth:
+                return 0
+            if not parent.include:
+                return 0
+
+            if parent.path:
+                include_paths = [dirname(parent.path), "."]
+            else:
+                include_paths = ["."]
+
+            parent._prefetched = dict()
+            count = 0
+            for n in range(len(parent.include)):
+                entry = parent.include[n]
+                if isinstance(entry, str) or isinstance(entry, unicode):
+                    include_file, serial = entry, None
+                elif "id" in entry:
+                    include_file, serial = entry["id"], entry.get("_serial")
+                else:
+                    # Reported by process_includes()
+                    continue
+
+                def done(result, parent=parent, n=n, depth=parent_depth):
+                    results.put((parent, n, depth, result))
+
+                pool.apply_async(load, (include_file, serial, include_paths),
+                                 callback=done)
+                count += 1
+            return count
+
+        try:
+            outstanding = submit(self, depth)
+            while outstanding:
+                try:
+                    # A get() without timeout cannot be interrupted with
+                    # Ctrl-C in Python 2
+                    parent, n, parent_depth, result = results.get(timeout=1)
+                except Queue.Empty:
+                    continue
+                outstanding -= 1
+                error = result[2]
+                if error and not issubclass(error[0], Exception):
+                    # Interrupted, stop instead of waiting for the rest
+                    raise error[0], error[1], error[2]
+                parent._prefetched[n] = result
+                if result[1] is not None:
+                    outstanding += submit(result[1], parent_depth + 1)
+            pool.close()
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    def merge(self, merge_from, disposable=False):
         '''
         Merges the merge_from JCF object into this one. Merge is done
         on each individual section separately depending on the structure for
         that particular section.
+
+        disposable = set to True if merge_from is thrown away after the merge
+                     (as in process_includes()). Its sections are then moved
+                     into this JCF instead of being deep copied, leaving
+                     merge_from sharing data with this object.
+
+        Stages and suts of merge_from whose names are already taken are
+        renamed, together with the variables that refer to them. Only
+        references to exactly that name are renamed, e.g. when sut db is
+        renamed to db_3:
+            ${suts.db.sys_ip}   -> ${suts.db_3.sys_ip}
+            ${suts.db_2.sys_ip} -> unchanged (was ${suts.db_3_2.sys_ip})
+            ${suts.dbx.sys_ip}  -> unchanged (was ${suts.db_3x.sys_ip})
+            ${suts.db}          -> unchanged
         '''
+        if disposable:
+            take = lambda data: data
+        else:
+            take = deepcopy
         # Merge Sections
         #     tags
         #     include (implicitly done via process_includes())
@@ -527,7 +1243,7 @@ class JCF(object):
         else:
             # self merges info merge_from
             # merge_from becomes new info section
-            x = deepcopy(merge_from.info)
+            x = take(merge_from.info)
             x.update(self.info)
             self.info = x
 
@@ -545,38 +1261,26 @@ class JCF(object):
 #        x = deepcopy(merge_from.suts)
 #        x.update(self.suts)
 #        self.suts = x
-        my_sut_names = self.suts.keys()
+        sut_renames = dict()
+        my_sut_names = set(self.suts.keys())
         merge_from_sut_names = merge_from.suts.keys()
+        sut_names = NameAllocator(list(my_sut_names) + merge_from_sut_names)
         for n in merge_from_sut_names:
             new_name = n
             if n in my_sut_names:
                 # Begin rename process
                 # Create a new name
-                i = 2
-                new_name = n + "_" + str(i)
-                while new_name in my_sut_names or new_name in merge_from_sut_names:
-                    i += 1
-                    new_name = n + "_" + str(i)
+                new_name, i = sut_names.allocate(n)
 
-                # Move sut to new name
+                # Move sut to new name, references to it are updated
+                # together with the stage references below
                 merge_from.suts[new_name] = merge_from.suts[n]
                 del merge_from.suts[n]
-
-                # Find and replace all variable references to this sut
-                var_re = r'\$\{suts\.(' + n + r')[-\w\s\. \[\]]+\}'
-                util.find_replace_re(merge_from.get_dict(), var_re, new_name)
-                merge_from.update_attributes()
-
-                # Find and replace all target controls referencing this sut
-                for stage_data in merge_from.stages.values():
-                    if "target" in stage_data and stage_data["target"] == n:
-                        stage_data["target"] = new_name
+                sut_renames[n] = new_name
 
             # Merge in new sut
             self.suts[new_name] = merge_from.suts[new_name]
 
-
-
         # Stages
         # TODO: need to determine how to best handle conflicts
         #   Options:
@@ -603,47 +1307,45 @@ class JCF(object):
         # identifiers
         # stage names in the merge_from must be tracked to update any
         # references to them within merge_from. Only merge_from may have
-        my_stage_names = self.get_stage_names()
+        # Index all references within merge_from once, renames of both suts
+        # and stages are then applied in a single batch
+        references = ReferenceIndex(merge_from)
+        stage_renames = dict()
+        my_stage_names = set(self.get_stage_names())
         merge_from_stage_names = merge_from.get_stage_names()
+        stage_names = NameAllocator(list(my_stage_names) +
+                                    merge_from_stage_names)
         for n in merge_from_stage_names:
             new_name = n
             if n in my_stage_names:
                 # Begin rename process
                 # Create a new name
-                i = 2
-                new_name = n + "_" + str(i)
-                while new_name in my_stage_names or new_name in merge_from_stage_names:
-                    i += 1
-                    new_name = n + "_" + str(i)
+                new_name, i = stage_names.allocate(n)
 
                 # Move stage to new name
                 merge_from.stages[new_name] = merge_from.stages[n]
                 merge_from.stages[new_name]["id"] = new_name
                 merge_from.stages[new_name]["instance"] = i
                 del merge_from.stages[n]
-
-                # Find and replace all variable references to this stage
-                var_re = r'\$\{stages\.(' + n + r')[-\w\s\. \[\]]+\}'
-                util.find_replace_re(merge_from.get_dict(), var_re, new_name)
-                merge_from.update_attributes()
-
-                # Find and replace all flow controls referencing this stage
-                for v in merge_from.stages.values():
-                    for fc in self.flow_controls:
-                        if fc in v and v[fc] == n:
-                            v[fc] = new_name
+                stage_renames[n] = new_name
 
             # Merge in new stage
             self.stages[new_name] = merge_from.stages[new_name]
 
+        # Find and replace all variable references, flow controls and targets
+        # referencing renamed suts and stages
+        references.rename(suts=sut_renames, stages=stage_renames)
+        merge_from.stages_changed()
+        self.stages_changed()
+
         # Ckey
         # ckeys in current JCF take precedence
-        x = deepcopy(merge_from.ckey)
+        x = take(merge_from.ckey)
         x.update(self.ckey)
         self.ckey = x
 
         # local
-        x = deepcopy(merge_from.local)
+        x = take(merge_from.local)
         x.update(self.local)
         self.local = x
 
@@ -651,7 +1353,7 @@ class JCF(object):
         # XXX templates in current JCF take precedence XXX
         # Note: Changed rules in bb3e9ae: now templates in merge JCF take
         # precedence
-        x = deepcopy(merge_from.ckey_template)
+        x = take(merge_from.ckey_template)
         self.ckey_template.update(x)
 
         # job_timeout
@@ -663,7 +1365,7 @@ class JCF(object):
             self.job_group = merge_from.job_group
         # configure
         if merge_from.configure:
-            x = deepcopy(merge_from.configure)
+            x = take(merge_from.configure)
             if self.configure:
                 x.update(self.configure)
             self.configure = x
@@ -680,8 +1382,39 @@ class JCF(object):
 
         The only check that made is for duplicate stage names. If encountered
         the dup stage is renamed by appending "_2" then "_3" etc.
+
+        Calls are skipped while the stages are the same as after a pass that
+        left them unchanged.
         '''
+        signature = self._stages_signature()
+        if signature is not None and signature == self._stages_processed:
+            return
+        self._process_stages()
+        if signature is not None and signature == self._stages_signature():
+            self._stages_processed = signature
 
+    def _stages_signature(self):
+        '''
+        Returns everything process_stages() reads as a string, equal strings
+        mean equal data. Returns None for data marshal cannot write.
+
+        Left out are self.order, which grows on every pass and only has to be
+        above the order of the stages that set one, and the order of the
+        stages dict, which a pass rebuilds. Once a pass leaves the stages
+        unchanged at most one stage has no next_* setting, so the result
+        does not depend on either.
+        '''
+        stages = self.stages
+        if isinstance(stages, dict):
+            stages = sorted(stages.items())
+        try:
+            return marshal.dumps((stages, self.init_stage,
+                                  self.auto_init_stage, self.max_depth,
+                                  list(self.flow_controls)), 0)
+        except ValueError:
+            return None
+
+    def _process_stages(self):
         if not self.stages:
             # No stages to process
             return
@@ -691,30 +1424,24 @@ class JCF(object):
         implicit_order_stages = list()
 
         if isinstance(self.stages, list):
-            # Make all names unique
-            for stage_index in range(len(self.stages)):
-                s = self.stages[stage_index]
-                id = s.keys()
-                if len(id) != 1:
+            for s in self.stages:
+                if len(s.keys()) != 1:
                     raise ValueError("JCF " + str(self.path) +
                                      " stages section is corrupt, each" +
                                      " list element must contain exactly" +
                                      " one stage")
+            stage_names = NameAllocator([s.keys()[0] for s in self.stages])
 
-                id = base_id = id[0]
+            # Make all names unique
+            for stage_index in range(len(self.stages)):
+                s = self.stages[stage_index]
+                id = base_id = s.keys()[0]
                 v = s[id]
 
-                # Create unique stage ID
-                i = 2
-                stage_names = [x.keys()[0] for x in self.stages]
-                try:
-                    # Remove my own ID from the list
-                    stage_names.remove(id)
-                except:
-                    pass
-                while id in stage_names:
-                    id = base_id + "_" + str(i)
-                    i += 1
+                # Create unique stage ID if another stage has the same one
+                if stage_names.count(id) > 1:
+                    stage_names.release(id)
+                    id, i = stage_names.allocate(base_id)
 
                 # Store new stage
                 self.stages[stage_index] = { id: v }
@@ -878,6 +1605,15 @@ class JCF(object):
                              "or enable a stage; " +
                              e.message)
 
+    def stages_changed(self):
+        '''
+        Drops cached stage information (see get_flow_graph()) after stage data
+        is modified in place: flow controls, disable, order, stages added or
+        removed... Assigning self.stages or self.flow_controls drops it by
+        itself.
+        '''
+        self._flow_graph = None
+
     def process_system_vars(self):
         '''
         Interpolates Cirrus system variables--these are special variables
@@ -924,17 +1660,63 @@ class JCF(object):
         if "cirrus_ip" in self.info and self.info["cirrus_ip"]:
             cirrus_ip = self.info["cirrus_ip"]
         else:
-            cirrus_ip = util.get_preferred_local_ip()
+            cirrus_ip = local_address.get()
 
         # Now replace all variable instances
         mapping["cirrus"] = cirrus_ip
 
+        # Replace all variables in a single walk of each section
+        replacements = dict()
         for k, v in mapping.items():
             if not k.startswith("$"):
                 k = "${" + k + "}"
-            util.find_replace(self.info, k, v)
-            util.find_replace(self.suts, k, v)
-            util.find_replace(self.stages, k, v)
+            replacements[k] = v
+        matcher = re.compile("|".join(
+            re.escape(k) for k in sorted(replacements, key=len, reverse=True)))
+
+        for section in (self.info, self.suts, self.stages):
+            self._replace_structure(section, matcher, replacements)
+        self.stages_changed()
+
+        # Keep tracked strings in line so re-interpolation does not bring
+        # back the system variables
+        tracker = self._interpolation_tracker
+        if tracker is not None:
+            for location, (source, scope) in tracker.leaves.items():
+                if location[0] in ("info", "suts", "stages"):
+                    new_source = self._replace_string(source, matcher,
+                                                      replacements)
+                    if new_source is not source:
+                        tracker.leaves[location] = (new_source, scope)
+
+    def _replace_string(self, string, matcher, replacements):
+        '''
+        Returns string with every match of matcher replaced by its value in
+        replacements, or string itself if nothing matched
+        '''
+        if "$" not in string:
+            return string
+        return matcher.sub(lambda m: replacements[m.group(0)], string)
+
+    def _replace_structure(self, structure, matcher, replacements):
+        '''
+        Recursive function to descend a structure and apply _replace_string()
+        to every string in place
+        '''
+        if isinstance(structure, dict):
+            items = structure.items()
+        elif isinstance(structure, list):
+            items = enumerate(structure)
+        else:
+            return
+
+        for k, v in items:
+            if isinstance(v, str) or isinstance(v, unicode):
+                new_v = self._replace_string(v, matcher, replacements)
+                if new_v is not v:
+                    structure[k] = new_v
+            elif isinstance(v, dict) or isinstance(v, list):
+                self._replace_structure(v, matcher, replacements)
 
     def process_file_vars(self):
         '''
@@ -958,32 +1740,49 @@ class JCF(object):
         else:
             self.interpolate_variables()
 
-    def process_ckey_defaults(self):
+    def process_ckey_defaults(self, check_types=True):
         '''
         This scans ckey_template section and inserts any missing settings into
         the ckey section if they are not present.
         It also checks that expected lists appear in list format.
+
+        check_types = also convert and check every ckey against its template
+                      data_type and options, see process_ckey_types(). Set
+                      it to False to load jobs that were accepted before the
+                      checks existed.
+        '''
+        if not self.ckey_template:
+            return
+
+        # Templates are merged once per unique ckey_template section
+        ckey_template.compile_defaults(self.ckey_template).apply(self.ckey,
+                                                                 self.path)
+        if check_types:
+            self.process_ckey_types()
+
+    def process_ckey_types(self):
+        '''
+        Converts the global and local ckey settings to the data_type given
+        in the ckey_template section (list, int, bool, string) and checks
+        them against the template options (enum).
+
+        Runs as part of process_ckey_defaults() unless check_types=False is
+        passed, so bad values are rejected at submission before the job is
+        started.
+
+        Exceptions:
+            ValueError listing every ckey with a bad value
         '''
         if not self.ckey_template:
             return
 
-        for serial in self.ckey_template:
-            ckeyList = self.ckey_template[serial]
-            for ct in ckeyList.keys():
-                if ct not in self.ckey:
-                    if "default" in ckeyList[ct]:
-                        self.ckey[ct] = ckeyList[ct]["default"]
-                    elif "hidden" in ckeyList[ct]:
-                        raise ValueError("JCF " + str(self.path) +
-                                         " hidden ckey_template setting " +
-                                         "'{0}' must have a default field".format(ct))
-
-                # Auto-create lists if expected
-                def_type = ckeyList[ct].get("data_type", "")
-                if (ct in self.ckey and
-                        def_type.lower() == "list" and
-                        not isinstance(self.ckey[ct], list)):
-                    self.ckey[ct] = [self.ckey[ct]]
+        table = ckey_template.compile_types(self.ckey_template)
+        errors = table.check(self.ckey or {})
+        for scope in sorted((self.local or {}).keys()):
+            errors.extend(table.check(self.local[scope], scope))
+        if errors:
+            raise ValueError("JCF " + str(self.path) +
+                             " invalid ckey values: " + "; ".join(errors))
 
     def process_singletons(self):
         # Gather all singletons by their ID
@@ -1051,11 +1850,21 @@ class JCF(object):
     def copy(self):
         return deepcopy(self)
 
+    def load_all(self):
+        '''
+        Loads every section that has not been accessed yet
+        '''
+        for name in self._deferred.keys():
+            if name in self._deferred:
+                getattr(self, name)
+
     def get_dict(self):
         '''
         Refreshes the raw member which is the raw JSON content (in a Python
         dict) and returns the data.
         '''
+        # Sections not loaded yet are read from the current raw data
+        self.load_all()
         self._raw = dict()
         for s in self.section_members:
             data = getattr(self, s)
@@ -1066,6 +1875,8 @@ class JCF(object):
 
     def update_attributes(self):
         # Reload data for all members
+        self.load_all()
+        self.stages_changed()
         self.info = self._raw.get("info", dict())
         self.init_stage = self._raw.get("init_stage", None)
         self.tags = self._raw.get("tags", [])
@@ -1095,12 +1906,21 @@ class JCF(object):
         # Returns stringified JSON syntax of this object
         return json.dumps(self.get_dict())
 
-    def write(self, filename=None):
+    def dump(self, fp, compact=False):
+        # Streams JSON syntax of this object into the file object fp
+        jsonio.dump(self.get_dict(), fp, compact)
+
+    def write(self, filename=None, compact=False):
+        '''
+        Writes the JCF to filename (defaults to the file it was read from).
+        The file is replaced atomically, see jsonio.py. Set compact to leave
+        out indentation.
+        '''
         if filename is None:
             filename = self.path
 
         # Write JSON
-        util.write_json(filename, self.get_raw())
+        jsonio.write_json(filename, self.get_raw(), compact)
 
     def get_stage_names(self):
         return self.stages.keys()
@@ -1157,20 +1977,29 @@ class JCF(object):
         is the first stage of the JCF as determined by process_stages()
         (the value of this is stored in auto_init_stage member).
         '''
-        ordered_stages = list()
-        unordered_stages = list()
-        visited_stages = dict()
+        ordered_stages, unordered_stages = self._stage_path(path, init_stage,
+                                                            stage_dict)
+        return {
+            path: ordered_stages,
+            "other": unordered_stages
+        }
 
+    def _stage_path(self, path="next_default", init_stage=None, stage_dict=None):
+        '''
+        Same as _get_stage_path() but returns the tuple (ordered, other) from
+        the flow graph
+        '''
         if stage_dict is None:
             if not isinstance(self.stages, dict):
                 self.process_stages()
             stage_dict = self.stages
+            if stage_dict:
+                graph = self.get_flow_graph()
+        elif stage_dict:
+            graph = FlowGraph(stage_dict, self.flow_controls)
 
         if not stage_dict:
-            return {
-                path: [],
-                "other": []
-            }
+            return [], []
 
         # Determine initial stage in this order of precedence:
         # - override passed into this function
@@ -1179,65 +2008,34 @@ class JCF(object):
         s = init_stage or self.init_stage or self.auto_init_stage
         if not s:
             # No init_stage so figure it out
-            all_stages = stage_dict.keys()
-
-            for id in copy(all_stages):
-                # The first stage is detected by looking for the one stage
-                # that won't have anything else pointing to it. This approach
-                # will work with most cases. Anything else is a configuration
-                # error.
-                if "order" in stage_dict[id] and stage_dict[id]["order"] is 1:
-                    all_stages = [id]
-                    break
-                if "next_pass" in stage_dict[id]:
-                    if stage_dict[id]["next_pass"] in all_stages:
-                        all_stages.remove(stage_dict[id]["next_pass"])
-                elif "next_default" in stage_dict[id]:
-                    if stage_dict[id]["next_default"] in all_stages:
-                        all_stages.remove(stage_dict[id]["next_default"])
-
-            if len(all_stages) == 1:
-                # Found the most likely initial stage
-                s = all_stages[0]
-            else:
-                err = "Cannot figure out initial stage from subset" + \
-                      " " + str(sorted(stage_dict.keys())) + "."
-                if len(all_stages) > 1:
-                    err += " Ambiguous candidates: " + str(sorted(all_stages))
-                else:
-                    err += " No candidates. Possible illegal stage loop."
-                err += " You could use 'init_stage' setting to resolve this."
-                raise ValueError(err)
+            s = graph.first_stage()
 
-        while(1):
-            if s in visited_stages:
-                # If stage is encountered twice we are in a loop, quit now
-                s = "_quit"
-            elif s in stage_dict:
-                # Stage is in JCF, add to list and use 'path' path to find
-                # the next
-                ordered_stages.append((s, stage_dict[s]))
-                visited_stages[s] = True
-                next_stage = stage_dict[s].get(path, "_next")
-                if not next_stage or next_stage == "_next":
-                    next_stage = stage_dict[s].get("next_default", "_quit")
-                    if not next_stage:
-                        next_stage = "_quit"
-                s = next_stage
-            else:
-                s = "_quit"
-
-            if s == "_quit":
-                break
-
-        # Calculate standalone stages
-        for id in sorted(list(set(stage_dict.keys()) - set(visited_stages.keys()))):
-            unordered_stages.append((id, self.stages[id]))
+        return graph.path(path, s)
 
-        return {
-            path: ordered_stages,
-            "other": unordered_stages
-        }
+    def get_flow_graph(self):
+        '''
+        Returns the FlowGraph of the stages. The graph is kept until
+        self.stages or self.flow_controls is assigned or stages_changed() is
+        called, so repeated navigation does not walk the flow again.
+        '''
+        if not isinstance(self.stages, dict):
+            self.process_stages()
+        stages = self.stages or {}
+        graph = self._flow_graph
+        if graph is None or graph.stages is not stages or \
+                graph.flow_controls is not self.flow_controls:
+            graph = self._flow_graph = FlowGraph(stages, self.flow_controls)
+        return graph
+
+    def get_next_stage(self, stage_name, path="next_default"):
+        '''
+        Returns a tuple (stage name, stage data) of the stage executed after
+        stage_name when following path, or None at the end of the flow
+        '''
+        next_stage = self.get_flow_graph().next_stage(stage_name, path)
+        if next_stage is None:
+            return None
+        return (next_stage, self.stages[next_stage])
 
     def get_ordered_stages(self, path="next_default", init_stage=None, stage_dict=None):
         '''
@@ -1285,7 +2083,7 @@ class JCF(object):
         Returns the first tuple that comes out of get_ordered_stages()
         which is (stage name, stage data)
         '''
-        stages = self.get_ordered_stages(stage_dict=stage_dict)
+        stages = self._stage_path(stage_dict=stage_dict)[0]
         if not stages:
             return None
         return stages[0]
@@ -1295,7 +2093,7 @@ class JCF(object):
         Returns the last tuple that comes out of get_ordered_stages()
         which is (stage name, stage data)
         '''
-        stages = self.get_ordered_stages(stage_dict=stage_dict)
+        stages = self._stage_path(stage_dict=stage_dict)[0]
         if not stages:
             return None
         return stages[-1]
@@ -1345,6 +2143,59 @@ class JCF(object):
             else:
                 return r
 
+    def get_ckeys(self, keys, scope=None, default=None, interpolate=False):
+        '''
+        Returns a dict of key -> value for every key in keys, each value being
+        what get_ckey(key, scope, default) returns. The scope is resolved once
+        for all keys.
+
+        interpolate = interpolate variables in string values, in the same
+                      scope the values are looked up in
+        '''
+        if scope == "*":
+            local = None
+        else:
+            if not scope:
+                scope = self._serial
+            local = self.local.get(scope)
+
+        values = dict()
+        for key in keys:
+            if scope == "*":
+                s = self.get_scope(key)
+                if s:
+                    r = self.local[s].get(key, default)
+                else:
+                    r = default
+            elif local is not None:
+                r = local.get(key, default)
+            else:
+                r = default
+            value = r or self.ckey.get(key, default)
+
+            if interpolate and (isinstance(value, str) or
+                                isinstance(value, unicode)):
+                value = self._interpolate_ckey(value, scope)
+            values[key] = value
+        return values
+
+    def get_ckey_snapshot(self, scope=None, interpolate=False):
+        '''
+        Returns a CkeySnapshot of all ckeys visible from scope, with the values
+        get_ckeys() returns for them. Values are copied so neither later
+        changes to the JCF nor changes to the snapshot values affect the
+        other.
+        '''
+        if scope == "*":
+            raise ValueError("Search of all scopes (*) requires a key")
+        keys = set(self.ckey)
+        keys.update(self.local.get(scope or self._serial) or ())
+        return CkeySnapshot(deepcopy(self.get_ckeys(keys, scope,
+                                                    interpolate=interpolate)))
+
+    def _interpolate_ckey(self, value, scope):
+        return self._interpolate_string(value, scope)
+
     def get_global_ckey(self, key=None, default=None):
         if key is not None:
             if key in self.ckey:
@@ -1376,16 +2227,69 @@ class JCF(object):
         else:
             return self.local[scope]
 
+    def get_ckey_view(self, scope=None):
+        '''
+        Returns a read-only view of the ckeys as seen from scope: local ckeys
+        of the scope over global ckeys. It holds the same keys and values as
+        get_ckey() without a key but nothing is copied, and it follows later
+        changes of the ckeys. Values are not copied either, do not modify
+        them.
+        '''
+        if not scope:
+            scope = self._serial
+        if scope == "*":
+            raise ValueError("Search of all scopes (*) requires a key")
+        local = self.local.get(scope)
+        if local is None:
+            local = dict()
+        return CkeyView(local, self.ckey or {})
+
     def get_scope(self, key):
         '''
         Returns the first scope that contains a given key
         '''
-        for s in self.local.keys():
-            if key and key in self.local[s]:
+        if not key:
+            return None
+        index = self._get_scope_index()
+        scope = index.get(key)
+        local = self.local
+        if scope is not None and key in local.get(scope, ()):
+            return scope
+
+        # Not indexed or not there any more, e.g. local ckeys changed in
+        # place: look through the scopes
+        for s in local.keys():
+            if key in local[s]:
+                index[key] = s
                 return s
         return None
 
-    def _interpolate_string(self, string, scope=None, filter=""):
+    def local_changed(self):
+        '''
+        Drops the scope index of get_scope() after local ckeys are changed in
+        place. get_scope() checks what the index finds against self.local and
+        looks through all scopes when it finds nothing, so it is not needed
+        for correct results. It only matters when a ckey is added to a scope
+        that comes before the one where the index already found it.
+        Assigning self.local drops the index by itself.
+        '''
+        self._scope_index = None
+
+    def _get_scope_index(self):
+        # ckey name -> first scope (in the order of the local section) that
+        # has it, rebuilt when local is replaced
+        index = self._scope_index
+        if index is None or index[0] is not self.local:
+            scopes = dict()
+            for s in self.local.keys():
+                for k in self.local[s]:
+                    if k not in scopes:
+                        scopes[k] = s
+            index = self._scope_index = (self.local, scopes)
+        return index[1]
+
+    def _interpolate_string(self, string, scope=None, filter="",
+                            recorder=None):
         '''
         This is the atomic function at the heart of all variable interpolation.
         It is the code that does the actual substitution.
@@ -1398,101 +2302,162 @@ class JCF(object):
                    "*" means search every scope that is available and returns
                    the first occurrence of a variable. If multiple occurrences
                    exist then one returned is unpredictable under "*" scope.
+                   The scope found for the first ckey variable met is then
+                   used for every other ckey variable of the string.
 
         filter = Limits interpolation to variables that start with filter.
                  For example if "suts" is the filter then only ${suts...}
                  variables will be interpolated.
+
+        recorder = interpolate.LookupRecorder that gets every path looked up,
+                   used for change tracking (see interpolate_variables())
         '''
-        var_re = r'(\$\{(' + filter + r'[- \w\s\.\:\[\]]+)\})'
-        obj_data = self.get_dict()
-
-        # Outer while loop will ensure we get all nested variables like
-        # string = "The ${var1} jumped over the fence"
-        #     ${var1} = "${var2}"
-        #     ${var2} = "dog"
-        loops = 0
-        while True:
-            matches = re.findall(var_re, string)
-            if not matches:
-                break
-            loops += 1
+        if "${" not in string:
+            return string
+
+        template = interpolate.compile_template(string, filter)
+        if not template.variables:
+            return string.replace("${}", "$")
+
+        if scope == "*":
+            if recorder is not None:
+                # Any local ckey can change the scope
+                recorder.paths.append(("local",))
+            scope = self._wildcard_scope(template, filter, recorder)
 
-            if loops >= 100:
-                raise ValueError("JCF " + str(self.path)
-                                 + "Infinite loop detected on string '"
-                                 + string)
+        value = self._render_template(template, scope, filter, [], recorder)
 
-            dups = dict()
-            for replaceme, key in matches:
-                # Skip duplicate matches as they have already been processed
-                if key in dups:
+        # Revert any missing values to their original state
+        if isinstance(value, str) or isinstance(value, unicode):
+            value = value.replace("${}", "$")
+        return value
+
+    def _render_template(self, template, scope, filter, active,
+                         recorder=None):
+        '''
+        Substitutes every variable of a compiled template.
+
+        Values that are strings are rendered again (same scope and filter) so
+        nested variables are handled, e.g.
+        string = "The ${var1} jumped over the fence"
+            ${var1} = "${var2}"
+            ${var2} = "dog"
+
+        active = variables currently being expanded, used to detect loops
+
+        recorder = see _interpolate_string()
+        '''
+        parts = list()
+        missing = dict()
+        for segment in template.segments:
+            if not isinstance(segment, interpolate.Variable):
+                parts.append(segment)
+                continue
+
+            path = self._variable_path(segment, scope)
+            if recorder is None:
+                found, value = self._lookup_path(path)
+            else:
+                found, value = recorder.lookup(self._lookup_path, path)
+                if scope and segment.ckey_name is not None:
+                    # Adding or removing the local ckey changes the path
+                    recorder.paths.append(segment.path)
+                    recorder.paths.append(("local", scope) + segment.path[1:])
+            if not found:
+                # There is no corresponding value for this key so flag the
+                # object as not fully interpolated and leave the variable
+                # as-is
+                if segment.key not in missing:
+                    missing[segment.key] = True
+                    self.interpolation_errors.append(segment.text)
+                parts.append(segment.text)
+                continue
+
+            if (isinstance(value, str) or isinstance(value, unicode)) and \
+                    "${" in value:
+                if segment.key in active or len(active) >= 100:
+                    raise ValueError("JCF " + str(self.path)
+                                     + "Infinite loop detected on string '"
+                                     + template.source)
+                active.append(segment.key)
+                value = self._render_template(
+                    interpolate.compile_template(value, filter),
+                    scope, filter, active, recorder)
+                active.pop()
+
+            # Return String or Structure?
+            #
+            # If variable is by itself like "${var}" as opposed to
+            # something like "My name is ${var}" then we allow this
+            # to morph into a structure reference.
+            if (template.single and
+                    not isinstance(value, str) and
+                    not isinstance(value, unicode)):
+                return value
+
+            parts.append(value)
+
+        return "".join(parts)
+
+    def _wildcard_scope(self, template, filter, recorder=None):
+        '''
+        Returns the scope a string is interpolated in under the "*" scope: the
+        scope of the first ckey variable met, looking at the variables of the
+        string first, then at the variables of their values and so on.
+        Returns "*" if no ckey variable is met.
+        '''
+        seen = set()
+        variables = template.variables
+        while variables:
+            nested = list()
+            for variable in variables:
+                if variable.ckey_name is not None:
+                    return self.get_scope(variable.ckey_name)
+                if variable.key in seen:
                     continue
+                seen.add(variable.key)
+                if recorder is None:
+                    found, value = self._lookup_path(variable.path)
                 else:
-                    dups[key] = True
-
-                # Change path1.path2.key into ['path1']['path2']['key']
-                key_parts = key.split(".")
-                key_string = str()
-
-                # Handle local variables (ckeys only) by redirecting
-                # interpolation to local section if the given ckey is
-                # found there
-                if scope and len(key_parts) > 1 and key_parts[0] == "ckey":
-                    k = key_parts[1]
-                    if scope == "*":
-                        scope = self.get_scope(k)
-                    if self.get_local_ckey(k, scope) != None:
-                        key_parts = list(key_parts)
-                        key_parts[0] = "local"
-                        key_parts.insert(1, scope)
-
-                # Look at each key part and identify any array refs
-                for kp in key_parts:
-                    m = re.search(r'(.+?)(\[\d+\])$', kp)
-                    if m:
-                        # array form: ['key'][#]
-                        key_string += "['" + m.group(1) + "']" + m.group(2)
-                    else:
-                        # non-array form: ['key']
-                        key_string += "['" + kp + "']"
+                    found, value = recorder.lookup(self._lookup_path,
+                                                   variable.path)
+                if found and (isinstance(value, str) or
+                              isinstance(value, unicode)) and "${" in value:
+                    nested.extend(
+                        interpolate.compile_template(value, filter).variables)
+            variables = nested
+        return "*"
+
+    def _variable_path(self, variable, scope=None):
+        '''
+        Returns the path a compiled interpolate.Variable points to in the given
+        scope
+        '''
+        path = variable.path
 
-                # See if key exists in this object
-                try:
-                    value = eval("obj_data" + key_string)
-
-                    # Return String or Structure?
-                    #
-                    # If variable is by itself like "${var}" as opposed to
-                    # something like "My name is ${var}" then we allow this
-                    # to morph into a structure reference.
-                    # First we detect this situation by comparing the
-                    # seeing if the variable string is the entire "replaceme."
-                    # In this case we need to check if the value we looked
-                    # up is a string or a structure. If it is not a str/unicode
-                    # then it must be a structure and so we will return
-                    # the structure instead.
-                    # However, if it turns out to be a string we treat it
-                    # normally and keep processing it for multiple
-                    # interpolation.
-                    if (replaceme == string and
-                            not isinstance(value, str) and
-                            not isinstance(value, unicode)):
-                        return value
-
-                except:
-                    # There is no corresponding value for this key so flag the
-                    # object as not fully interpolated, change the key so it
-                    # appears empty which will prevent it from being processed
-                    # again.
-                    self.interpolation_errors.append(replaceme)
-                    value = replaceme.replace("${", "${}{")
-
-                # Replace all instances
-                string = string.replace(replaceme, value)
+        # Handle local variables (ckeys only) by redirecting
+        # interpolation to local section if the given ckey is
+        # found there
+        if scope and variable.ckey_name is not None:
+            k = variable.ckey_name
+            if scope == "*":
+                scope = self.get_scope(k)
+            if self.get_local_ckey(k, scope) != None:
+                path = ("local", scope) + path[1:]
 
-        # Revert any missing values to their original state
-        string = string.replace("${}", "$")
-        return string
+        return path
+
+    def _lookup_path(self, path):
+        '''
+        Returns (found, value) for a path such as ("stages", "a", "action")
+        '''
+        # Only sections with content are visible, same as get_dict()
+        if path[0] not in self.section_members:
+            return False, None
+        data = getattr(self, path[0])
+        if not data:
+            return False, None
+        return interpolate.lookup(data, path[1:])
 
     def get_stage_ckey(self, stage_id, ckey=None, default=None):
         s = self.get_stage_by_name(stage_id)
@@ -1501,7 +2466,8 @@ class JCF(object):
 
         return self.get_local_ckey(ckey, s.get("_serial", None), default)
 
-    def _interpolate_structure(self, structure, scope=None, filter=""):
+    def _interpolate_structure(self, structure, scope=None, filter="",
+                               tracker=None, location=None):
         '''
         Recursive function to descend JCF structure and interpolate every
         string
@@ -1516,9 +2482,14 @@ class JCF(object):
         filter    = Limits interpolation to variables that start with filter.
                     For example if "suts" is the filter then only ${suts...}
                     variables will be interpolated.
+        tracker   = interpolate.DependencyIndex to add the strings to, with
+                    location the tuple of keys leading to structure
 
         '''
         if isinstance(structure, str) or isinstance(structure, unicode):
+            if tracker is not None and "${" in structure:
+                tracker.add(location, structure, scope)
+                return self._interpolate_leaf(tracker, location)
             return self._interpolate_string(structure, scope, filter)
         elif isinstance(structure, dict):
             if "_serial" in structure:
@@ -1526,18 +2497,21 @@ class JCF(object):
             for k in structure.keys():
                 orig = structure[k]
                 structure[k] = self._interpolate_structure(
-                    structure[k], scope, filter)
+                    structure[k], scope, filter, tracker,
+                    location + (k,) if tracker is not None else None)
         elif isinstance(structure, list):
             for i in range(len(structure)):
                 structure[i] = self._interpolate_structure(
-                    structure[i], scope, filter)
+                    structure[i], scope, filter, tracker,
+                    location + (i,) if tracker is not None else None)
 
         # This will return as-is data types that cannot be interpolated
         # (numbers, booleans, etc.) or return the recursively modified
         # structure.
         return structure
 
-    def interpolate_variables(self, section=None, scope=None, filter=""):
+    def interpolate_variables(self, section=None, scope=None, filter="",
+                              track=False):
         '''
         Scan entire object for strings that look like variables and replace
         them with actual values.
@@ -1564,6 +2538,9 @@ class JCF(object):
         filter  = Limits interpolation to variables that start with filter.
                   For example if "suts" is the filter then only ${suts...}
                   variables will be interpolated.
+        track   = remember which strings depend on which variables so that
+                  update() and reinterpolate() only need to re-interpolate the
+                  strings affected by a change.
 
         Sections that can contain variables:
             suts
@@ -1571,6 +2548,35 @@ class JCF(object):
             ckey
             local_ckey
             info
+
+        Variables are looked up in the scope of the object holding them,
+        nested variables are rendered in the same scope and unresolved
+        variables are left in place:
+        >>> jcf = JCF({"info": {"_serial": "J"},
+        ...            "ckey": {"host": "h1", "cmd": "ping ${ckey.host}"},
+        ...            "local": {"S": {"host": "h2"}},
+        ...            "suts": {"sut": {"ids": ["a", "b"]}},
+        ...            "stages": {"a": {"_serial": "S", "run": "${ckey.cmd}"},
+        ...                       "b": {"_serial": "J",
+        ...                             "run": "${ckey.cmd} ${suts.sut.ids[1]}",
+        ...                             "sut": "${suts.sut}",
+        ...                             "x": "${ckey.none}"}}})
+        >>> jcf.interpolate_variables()
+        >>> jcf.stages["a"]["run"], jcf.stages["b"]["run"]
+        ('ping h2', 'ping h1 b')
+        >>> jcf.stages["b"]["sut"] is jcf.suts["sut"]
+        True
+        >>> jcf.stages["b"]["x"], jcf.interpolation_errors
+        ('${ckey.none}', ['${ckey.none}'])
+
+        Under "*" scope the rest of a string is looked up in the scope of its
+        first ckey variable:
+        >>> jcf = JCF({"ckey": {"host": "h1", "port": "80"},
+        ...            "local": {"S": {"host": "h2"}, "T": {"port": "8080"}},
+        ...            "suts": {"sut": {"addr": "${ckey.host}:${ckey.port}"}}})
+        >>> jcf.interpolate_variables(section="suts", scope="*")
+        >>> jcf.suts["sut"]["addr"]
+        'h2:80'
         '''
 
         # Clear interpolation errors, if there is something missing it will
@@ -1580,21 +2586,318 @@ class JCF(object):
         if section is not None and not isinstance(section, list):
             section = [section]
 
+        # Any previous change tracking no longer matches the data
+        self._interpolation_tracker = None
+
+        tracker = None
+        if track:
+            tracker = interpolate.DependencyIndex(
+                scope, filter, [s for s in ("suts", "stages", "ckey", "info")
+                                if not section or s in section])
+
         # Interpolate all supported sections
         if not section or "suts" in section:
-            self.suts = self._interpolate_structure(self.suts, scope, filter)
+            self.suts = self._interpolate_structure(self.suts, scope, filter,
+                                                    tracker, ("suts",))
             # Convert list to string for SUT name and ID
             for sut_name in self.suts:
                 sut_data = self.suts[sut_name]
                 for f in "id", "name":
                     if f in sut_data and isinstance(sut_data[f], list) and sut_data[f]:
+                        if tracker is not None:
+                            tracker.sut_lists[("suts", sut_name, f)] = sut_data[f]
                         sut_data[f] = sut_data[f][0]
         if not section or "stages" in section:
-            self.stages = self._interpolate_structure(self.stages, scope, filter)
+            self.stages = self._interpolate_structure(self.stages, scope, filter,
+                                                      tracker, ("stages",))
+            self.stages_changed()
         if not section or "ckey" in section:
-            self.ckey = self._interpolate_structure(self.ckey, scope, filter)
+            self.ckey = self._interpolate_structure(self.ckey, scope, filter,
+                                                    tracker, ("ckey",))
         if not section or "info" in section:
-            self.info = self._interpolate_structure(self.info, scope, filter)
+            self.info = self._interpolate_structure(self.info, scope, filter,
+                                                    tracker, ("info",))
+
+        self._interpolation_tracker = tracker
+
+    def _interpolate_leaf(self, tracker, location, position=None):
+        '''
+        Interpolates the string tracker holds for location and records the
+        paths it depends on. position is passed on to
+        interpolate.LookupRecorder.
+        '''
+        source, scope = tracker.leaves[location]
+        recorder = interpolate.LookupRecorder(tracker, position)
+        errors = len(self.interpolation_errors)
+        value = self._interpolate_string(source, scope, tracker.filter,
+                                         recorder)
+        tracker.set_dependencies(location, recorder.paths)
+        if len(self.interpolation_errors) > errors:
+            tracker.errors[location] = self.interpolation_errors[errors:]
+        else:
+            tracker.errors.pop(location, None)
+        return value
+
+    def _collect_templates(self, structure, scope, filter, leaves, location=()):
+        '''
+        Recursive function to descend JCF structure and gather every string
+        containing variables. Scope follows the same rules as
+        _interpolate_structure(). Each leaf is appended to leaves as a tuple:
+        (container, key or index, template, scope, location)
+        where location is the tuple of keys leading to the string.
+        '''
+        if isinstance(structure, dict):
+            if "_serial" in structure:
+                scope = structure["_serial"]
+            items = structure.items()
+        elif isinstance(structure, list):
+            items = enumerate(structure)
+        else:
+            return
+
+        for k, v in items:
+            if isinstance(v, str) or isinstance(v, unicode):
+                if "${" in v:
+                    leaves.append((structure, k,
+                                   interpolate.compile_template(v, filter),
+                                   scope, location + (k,)))
+            elif isinstance(v, dict) or isinstance(v, list):
+                self._collect_templates(v, scope, filter, leaves,
+                                        location + (k,))
+
+    def reinterpolate(self, paths):
+        '''
+        Re-interpolates only the strings that depend on the given paths, e.g.
+        [("ckey", "wait"), ("local", serial, "wait"), ("suts", "sut")]
+
+        Requires a previous interpolate_variables(track=True), otherwise the
+        whole JCF is interpolated again.
+        '''
+        tracker = self._interpolation_tracker
+        if tracker is None:
+            self.interpolate_variables()
+            return
+
+        self._reinterpolate_leaves(tracker.dependents(paths))
+
+    def _reinterpolate_leaves(self, locations):
+        '''
+        Interpolates the tracked strings at locations again, in the order
+        they were first interpolated, along with the strings after them that
+        use a string whose value changes. Strings are seen the way a full run
+        sees them: interpolated if they come earlier, original otherwise.
+
+        When the strings are a large share of all tracked strings, or sut
+        ids or names that were lists are involved, the whole tracked part of
+        the JCF is interpolated again instead.
+        '''
+        tracker = self._interpolation_tracker
+        if 2 * len(locations) > len(tracker.leaves):
+            self._interpolate_tracked_again()
+            return
+
+        positions = tracker.positions
+        pending = [(positions[l], l) for l in locations if l in positions]
+        heapq.heapify(pending)
+        queued = set(locations)
+        while pending:
+            position, location = heapq.heappop(pending)
+            if location[0] == "suts" and tracker.sut_lists:
+                # Strings of suts see sut ids and names as lists
+                self._interpolate_tracked_again()
+                return
+
+            container = self._leaf_container(location)
+            if container is None:
+                # The string is gone
+                tracker.remove(location)
+                continue
+
+            k = location[-1]
+            old = container[k]
+            value = self._interpolate_leaf(tracker, location, position)
+            if location[0] == "suts" and len(location) == 3 and \
+                    location[2] in ("id", "name") and \
+                    isinstance(value, list) and value:
+                self._interpolate_tracked_again()
+                return
+            container[k] = value
+            if location[0] == "stages":
+                self.stages_changed()
+
+            if value is not old and value != old:
+                # Only strings after this one see the new value
+                for dependent in tracker.dependents([location]):
+                    if dependent not in queued and \
+                            positions[dependent] > position:
+                        queued.add(dependent)
+                        heapq.heappush(pending,
+                                       (positions[dependent], dependent))
+
+        self.interpolation_errors = list()
+        for location in sorted(tracker.errors, key=positions.get):
+            self.interpolation_errors.extend(tracker.errors[location])
+
+    def _interpolate_tracked_again(self):
+        '''
+        Puts the original strings back and interpolates the tracked sections
+        again with the same settings
+        '''
+        tracker = self._interpolation_tracker
+        for location, value in tracker.sut_lists.items():
+            found, sut = self._lookup_path(location[:-1])
+            if found and isinstance(sut, dict) and location[-1] in sut:
+                sut[location[-1]] = value
+        for location, (source, scope) in tracker.leaves.items():
+            container = self._leaf_container(location)
+            if container is not None:
+                container[location[-1]] = source
+        self.interpolate_variables(tracker.sections, tracker.scope,
+                                   tracker.filter, track=True)
+
+    def _leaf_container(self, location):
+        '''
+        Returns the dict or list that holds the value at location or None if
+        there is no such value any more
+        '''
+        found, container = self._lookup_path(location[:-1])
+        k = location[-1]
+        if found and isinstance(container, dict) and k in container:
+            return container
+        if found and isinstance(container, list) and isinstance(k, int) and \
+                k < len(container):
+            return container
+        return None
+
+    def update(self, data):
+        '''
+        Applies a partial JCF such as the data sent by LiveJCF.update().
+        Dicts are merged key by key, any other value replaces the current one.
+
+        If interpolation is being tracked (see interpolate_variables()) new
+        strings are interpolated and only existing strings that depend on the
+        changed values are re-interpolated.
+
+        The result is the same as interpolating the updated data from scratch:
+        >>> import copy
+        >>> data = {"info": {"_serial": "J"},
+        ...         "ckey": {"host": "h1", "cmd": "ping ${ckey.host}"},
+        ...         "local": {"S": {"host": "h2"}},
+        ...         "stages": {"a": {"_serial": "S", "run": "${ckey.cmd}"},
+        ...                    "b": {"_serial": "J",
+        ...                          "run": "${ckey.cmd} ${stages.a.run}"}}}
+        >>> jcf = JCF(copy.deepcopy(data))
+        >>> jcf.interpolate_variables(track=True)
+        >>> sorted(jcf.update({"ckey": {"host": "h3"},
+        ...                    "stages": {"c": {"_serial": "J",
+        ...                                     "run": "${ckey.host}"}}}))
+        [('ckey', 'host'), ('stages', 'c')]
+        >>> jcf.stages["b"]["run"]
+        'ping h3 ping h2'
+        >>> fresh = JCF(copy.deepcopy(data))
+        >>> fresh.ckey["host"] = "h3"
+        >>> fresh.stages["c"] = {"_serial": "J", "run": "${ckey.host}"}
+        >>> fresh.interpolate_variables()
+        >>> jcf.get_dict() == fresh.get_dict()
+        True
+
+        Returns the list of changed paths.
+        '''
+        changed = list()
+        for section, value in data.items():
+            if section not in self.section_members:
+                raise ValueError("JCF " + str(self.path) +
+                                 " update contains unrecognized section: " +
+                                 section)
+            current = getattr(self, section)
+            if isinstance(value, dict) and isinstance(current, dict):
+                self._update_structure(current, value, (section,), changed)
+            else:
+                setattr(self, section, value)
+                changed.append((section,))
+
+        sections = set([path[0] for path in changed])
+        if "stages" in sections:
+            self.stages_changed()
+        if "local" in sections:
+            self.local_changed()
+
+        tracker = self._interpolation_tracker
+        if tracker is not None:
+            # Forget strings that were replaced and pick up new ones
+            leaves = list()
+            for path in changed:
+                tracker.remove_under(path)
+                if path[0] in tracker.sections:
+                    self._collect_templates_at(path, tracker, leaves)
+            for container, k, template, scope, location in leaves:
+                tracker.add(location, template.source, scope)
+
+            if "suts" in sections and "suts" in tracker.sections and \
+                    self._sut_lists(changed):
+                # Turned into their first element by a full run only
+                self._interpolate_tracked_again()
+            else:
+                locations = tracker.dependents(changed)
+                locations.update([l[4] for l in leaves])
+                self._reinterpolate_leaves(locations)
+
+        return changed
+
+    def _sut_lists(self, changed):
+        '''
+        Returns True if any sut at or below the changed paths has an id or
+        name that is a list
+        '''
+        if not isinstance(self.suts, dict):
+            return False
+        for path in changed:
+            if path[0] != "suts":
+                continue
+            if len(path) == 1:
+                names = self.suts.keys()
+            else:
+                names = [path[1]]
+            for name in names:
+                sut = self.suts.get(name)
+                if not isinstance(sut, dict):
+                    continue
+                for f in "id", "name":
+                    if isinstance(sut.get(f), list) and sut[f]:
+                        return True
+        return False
+
+    def _update_structure(self, current, data, path, changed):
+        for k, v in data.items():
+            if isinstance(v, dict) and isinstance(current.get(k), dict):
+                self._update_structure(current[k], v, path + (k,), changed)
+            else:
+                current[k] = v
+                changed.append(path + (k,))
+
+    def _collect_templates_at(self, path, tracker, leaves):
+        '''
+        Same as _collect_templates() for the value found at path, using the
+        scope that applies at that location
+        '''
+        scope = tracker.scope
+        data = getattr(self, path[0])
+        for k in path[1:]:
+            if isinstance(data, dict) and "_serial" in data:
+                scope = data["_serial"]
+            parent = data
+            try:
+                data = data[k]
+            except Exception:
+                return
+
+        if isinstance(data, str) or isinstance(data, unicode):
+            if "${" in data and len(path) > 1:
+                leaves.append((parent, path[-1],
+                               interpolate.compile_template(data, tracker.filter),
+                               scope, path))
+        else:
+            self._collect_templates(data, scope, tracker.filter, leaves, path)
 
     def resolve_sut(self, id):
         # See if ID is literal
@@ -1646,46 +2949,89 @@ class JCF(object):
 
         stage_list is a list of stage IDs to skip
 
+        Each flow control is followed through consecutive skipped stages to
+        the first stage that is not skipped. All targets are worked out from
+        the flow as it was before the call and then applied together.
+
+        >>> jcf = JCF({"stages": {"a": {"next_default": "b"},
+        ...                       "b": {"next_default": "c", "next_fail": "d"},
+        ...                       "c": {"next_default": "d"}, "d": {}}})
+        >>> jcf.skip_stages(["b", "c"])
+        >>> jcf.stages["a"]["next_default"], jcf.stages["b"]["next_fail"]
+        ('d', 'd')
+
+        The init stage is moved as well:
+        >>> jcf = JCF({"init_stage": "a",
+        ...            "stages": {"a": {"next_default": "b", "next_fail": "c"},
+        ...                       "b": {"next_pass": "c"}, "c": {}}})
+        >>> jcf.skip_stages(["a", "b"])
+        >>> jcf.init_stage
+        'c'
+
         Exceptions:
-            FlowError if an infinite loop is detected
+            FlowError if an infinite loop is detected, the message lists the
+            stages in the loop
         '''
         if not stage_list:
             return
 
-        reroutes = True
-        depth = 0
-        while reroutes:
-            reroutes = False
-            depth += 1
+        skipped = set(stage_list)
+        # (skipped stage, flow control) -> (final target, number of skipped
+        # stages passed through to get there)
+        final = dict()
+
+        def step(stage, fc):
+            d_stage = self.stages[stage]
+            if "next_pass" in d_stage:
+                return d_stage["next_pass"]
+            return d_stage.get(fc, d_stage["next_default"])
+
+        def resolve(target, fc):
+            # Follow the chain of skipped stages to the first stage that is
+            # not skipped, remembering the answer for every stage passed
+            chain = list()
+            on_chain = dict()
+            s = target
+            depth = 0
+            while s in skipped:
+                if (s, fc) in final:
+                    s, depth = final[(s, fc)]
+                    break
+                if s in on_chain:
+                    raise FlowError("Infinite loop detected in flow " +
+                                    "through stages: " +
+                                    " -> ".join(chain[on_chain[s]:] + [s]))
+                on_chain[s] = len(chain)
+                chain.append(s)
+                s = step(s, fc)
+
+            for i in range(len(chain)):
+                final[(chain[i], fc)] = (s, depth + len(chain) - i)
+            depth += len(chain)
 
             # Possible looping stage, give up
             if self.max_depth != -1 and depth > self.max_depth:
                 raise FlowError("Infinite loop detected in flow; depth=" +
-                                str(depth - 1))
+                                str(depth))
+            return s
 
-            # Route init stage
-            if self.init_stage in stage_list:
-                d_stage = self.stages[self.init_stage]
-                if "next_pass" in d_stage:
-                    new_fc = d_stage["next_pass"]
-                else:
-                    new_fc = d_stage["next_default"]
-                self.init_stage = new_fc
-                reroutes = True
-
-            # Route any other stages so they point to the next stage
-            # If the next stage is also disabled it will be rerouted
-            # again on the next loop
-            for id, s in self.stages.items():
-                for fc in self.flow_controls:
-                    if s.get(fc, None) in stage_list:
-                        d_stage = self.stages[s[fc]]
-                        if "next_pass" in d_stage:
-                            new_fc = d_stage["next_pass"]
-                        else:
-                            new_fc = d_stage.get(fc, d_stage["next_default"])
-                        s[fc] = new_fc
-                        reroutes = True
+        # Work out every new target from the flow as it is before changing
+        # anything
+        reroutes = list()
+        for id, s in self.stages.items():
+            for fc in self.flow_controls:
+                if s.get(fc, None) in skipped:
+                    reroutes.append((s, fc, resolve(s[fc], fc)))
+
+        # Route init stage
+        if self.init_stage in skipped:
+            self.init_stage = resolve(self.init_stage, "next_pass")
+
+        # Route any other stages so they point to the next stage
+        for s, fc, new_fc in reroutes:
+            s[fc] = new_fc
+
+        self.stages_changed()
 
     def remove_stages(self, stage_list):
         '''
@@ -1701,6 +3047,112 @@ class JCF(object):
         for s in stage_list:
             if s in self.stages:
                 del self.stages[s]
+        self.stages_changed()
+
+
+class LazyJCF(JCF):
+    '''
+    JCF that only does the work for the sections that are used.
+
+    info, local and origination are set up on creation like in JCF, they are
+    needed for the serial number. Every other section is only taken from the
+    source data the first time it is accessed:
+    - pre-parsed dicts are not deep copied up front, each section is copied
+      when first accessed
+    - stage serial numbers are set when stages are first accessed
+    - includes are checked for templates when include or templates are
+      first accessed
+
+    Otherwise it behaves the same as JCF, e.g. for listing jobs:
+    jcf = LazyJCF(file)
+    print jcf.info["name"], jcf.tags
+
+    Sections that were never accessed are still written out:
+    >>> import json, os, tempfile
+    >>> fd, path = tempfile.mkstemp(suffix=".json")
+    >>> os.close(fd)
+    >>> JCF({"info": {"name": "job"}, "tags": ["t"], "stages": {"a": {}},
+    ...      "suts": {"s": {}}, "ckey": {"k": "v"}}).write(path)
+    >>> before = json.load(open(path))
+    >>> jcf = LazyJCF(path)
+    >>> jcf.info["name"]
+    u'job'
+    >>> jcf.write()
+    >>> json.load(open(path)) == before
+    True
+    >>> os.remove(path)
+    '''
+
+    # Sections loaded on creation
+    eager_sections = ["info", "local", "local_ckey", "origination"]
+
+    def __getattr__(self, name):
+        # Only called for members that are not set, i.e. deferred sections
+        deferred = self.__dict__.get("_deferred")
+        if not deferred or name not in deferred:
+            raise AttributeError("'" + type(self).__name__ +
+                                 "' object has no attribute '" + name + "'")
+        getattr(self, deferred[name])(name)
+        return self.__dict__[name]
+
+    def __setattr__(self, name, value):
+        deferred = self.__dict__.get("_deferred")
+        if deferred and name in deferred:
+            # Assigned before it was loaded, the raw data is not used
+            del deferred[name]
+        object.__setattr__(self, name, value)
+
+    def _copy_source(self, json_src):
+        raw = dict(json_src)
+        for name in self.eager_sections:
+            if name in raw:
+                raw[name] = deepcopy(raw[name])
+        self._borrowed = True
+        return raw
+
+    def _load_sections(self, raw):
+        self._raw = raw
+        for name in self.section_members:
+            if name in self.eager_sections:
+                setattr(self, name, self._section(raw, name))
+            else:
+                self.__dict__.pop(name, None)
+                self._deferred[name] = "_load_section"
+        self._deferred["stages"] = "_load_stages"
+
+    def _find_templates(self):
+        self.__dict__.pop("templates", None)
+        self._deferred["include"] = "_load_include"
+        self._deferred["templates"] = "_load_include"
+
+    def _propagate_serial(self):
+        if "stages" not in self._deferred:
+            JCF._propagate_serial(self)
+
+    def _load_section(self, name):
+        del self._deferred[name]
+        value = self._section(self._raw, name)
+        if self._borrowed and name in self._raw:
+            value = self._raw[name] = deepcopy(value)
+        setattr(self, name, value)
+
+    def _load_stages(self, name):
+        self._load_section(name)
+        JCF._propagate_serial(self)
+
+    def _load_include(self, name):
+        # include and templates are loaded together, an assigned include or
+        # templates is kept as it is
+        templates = self.__dict__.get("templates")
+        keep_templates = "templates" not in self._deferred
+        self._deferred.pop("templates", None)
+        self.templates = None
+        if "include" in self._deferred:
+            self._load_section("include")
+        JCF._find_templates(self)
+        if keep_templates:
+            self.templates = templates
+
 
 
 # TODO: Rename Module to something else--the term is overloaded and not accurate in this case
@@ -1867,38 +3319,99 @@ class Module(JCF):
             scope = self.get_stage_data().get("_serial", None)
         return super(Module, self).get_local_ckey(key, scope, default)
 
+    def get_ckey_view(self, scope=None):
+        if scope is None:
+            scope = self.get_stage_data().get("_serial", None)
+        return super(Module, self).get_ckey_view(scope)
+
+    def get_ckeys(self, keys, scope=None, default=None, interpolate=False):
+        '''
+        Same as JCF.get_ckeys() but the scope defaults to that of the active
+        stage, and interpolation also replaces the module system variables
+        (see interpolate_string())
+        '''
+        if scope is None:
+            scope = self.get_stage_data().get("_serial", None)
+        return super(Module, self).get_ckeys(keys, scope, default, interpolate)
+
+    def get_ckey_snapshot(self, scope=None, interpolate=False):
+        if scope is None:
+            scope = self.get_stage_data().get("_serial", None)
+        return super(Module, self).get_ckey_snapshot(scope, interpolate)
+
+    def _interpolate_ckey(self, value, scope):
+        return self.interpolate_string(value, scope)
+
 
 class Status(object):
+    '''
+    Access to the job status file.
+
+    With autoupdate the getters and setters read the file again first, but
+    only if its modification time, size or inode changed since it was last
+    read or written. Use batch() to read it once for several getters:
+
+    with status.batch():
+        code = status.get_stage_code(name)
+        message = status.get_stage_message(name)
+    '''
 
     def __init__(self, status_file, autoupdate=True):
         self.status_file = status_file
         self.status = None
         self.autoupdate = autoupdate
+        # file_signature() of the status file when self.status was read
+        self._signature = None
+        self._batch_depth = 0
 
-    def update(self):
-        self.status = util.read_json(self.status_file)
+    def update(self, force=False):
+        '''
+        Reads the status file if it changed since it was last read or if
+        force is set
+        '''
+        try:
+            signature = file_signature(self.status_file)
+        except OSError:
+            signature = None
+        if (not force and signature is not None and
+                signature == self._signature and self.status is not None):
+            return
+        self.status = jsonio.read_json(self.status_file)
+        self._signature = signature
 
     def write(self):
-        util.write_json(self.status_file, self.status)
+        jsonio.write_json(self.status_file, self.status)
+        try:
+            self._signature = file_signature(self.status_file)
+        except OSError:
+            self._signature = None
 
-    def _get_job_data(self, key):
-        if self.autoupdate:
+    def batch(self):
+        '''
+        Returns a context manager within which the status file is read only
+        once, on entry, instead of for every getter
+        '''
+        return StatusBatch(self)
+
+    def _auto_update(self):
+        if self.autoupdate and not self._batch_depth:
             self.update()
+
+    def _get_job_data(self, key):
+        self._auto_update()
         if self.status and key in self.status:
             return self.status[key]
         else:
             return None
 
     def _get_stage_data(self, name, key):
-        if self.autoupdate:
-            self.update()
+        self._auto_update()
         if self.status and "stages" in self.status and name in self.status["stages"]:
             return self.status["stages"][name].get(key, None)
         return None
 
     def _set_stage_data(self, name, key, value):
-        if self.autoupdate:
-            self.update()
+        self._auto_update()
 
         if not self.status:
             self.status = dict()
@@ -1952,8 +3465,9 @@ class Status(object):
         return self._get_stage_data(name, "time_end")
 
     def get_stage_duration(self, name):
-        end = self.get_stage_time_end(name)
-        start = self.get_stage_time_start(name)
+        with self.batch():
+            end = self.get_stage_time_end(name)
+            start = self.get_stage_time_start(name)
         if not start or not end:
             return None
         return end - start
@@ -1977,13 +3491,32 @@ class Status(object):
         return self._get_job_data("time_end")
 
     def get_job_duration(self):
-        end = self.get_job_time_end()
-        start = self.get_job_time_start()
+        with self.batch():
+            end = self.get_job_time_end()
+            start = self.get_job_time_start()
         if not start or not end:
             return None
         return end - start
 
 
+class StatusBatch(object):
+    '''
+    Context manager returned by Status.batch()
+    '''
+
+    def __init__(self, status):
+        self.status = status
+
+    def __enter__(self):
+        if self.status.autoupdate and not self.status._batch_depth:
+            self.status.update()
+        self.status._batch_depth += 1
+        return self.status
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.status._batch_depth -= 1
+
+
 class LiveStatus(Status):
     '''
     Same as Status but uses the Agent for certain I/O operations
@@ -1997,8 +3530,7 @@ class LiveStatus(Status):
             time.sleep(3)
 
     def _set_stage_data(self, name, key, value):
-        if self.autoupdate:
-            self.update()
+        self._auto_update()
 
         d = {
             "stages": {
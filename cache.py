@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+
+''' cache
+Process-wide caches: parsed JSON files and the local IP address.
+
+Library JCFs (reboot, install, collect-logs...) are included by most jobs and
+by many other includes. ParsedFileCache keeps the parsed content of such files
+so each one is read and decoded once per process instead of once per include.
+
+Entries are keyed by the resolved path and validated against the file's
+modification time, size and inode, so an edited file is re-read on next use.
+The least recently used entries are evicted once the cache grows past
+max_bytes.
+
+Only a marshal serialization of the parsed data is kept, which is also what
+max_bytes counts. Callers get their own copy of the data (get()) which they
+are free to modify. Copies are made from the serialization, which is much
+faster than decoding the JSON again or deep copying it.
+
+LocalAddress keeps the result of util.get_preferred_local_ip(), which
+enumerates the network interfaces, for a limited time so that building many
+JCF objects does not look it up for every one of them.
+
+Usage:
+data = include_cache.get(path)
+ip = local_address.get()
+'''
+
+
+import collections
+import marshal
+import os
+import threading
+import time
+
+from .. import util
+from . import jsonio
+
+
+class ParsedFileCache(object):
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, loader=None):
+        '''
+        max_bytes = memory cap, the total size of the serialized entries
+        loader    = callable(path) returning parsed data, defaults to
+                    jsonio.read_json
+        '''
+        self.max_bytes = max_bytes
+        self.loader = loader or jsonio.read_json
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # path -> entry (see _load()), least recently used first
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+
+    def get(self, path):
+        '''
+        Returns a private copy of the parsed content of path
+        '''
+        entry, data = self._load(path)
+        if data is None:
+            data = marshal.loads(entry["blob"])
+        return data
+
+    def discard(self, path):
+        with self._lock:
+            self._remove(abspath_key(path))
+
+    def clear(self):
+        with self._lock:
+            self._entries = collections.OrderedDict()
+            self._bytes = 0
+
+    def _load(self, path):
+        path = abspath_key(path)
+        signature = file_signature(path)
+
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry["signature"] == signature:
+                self.hits += 1
+                # Move to the most recently used end
+                del self._entries[path]
+                self._entries[path] = entry
+                return entry, None
+
+        # Read outside of the lock, worst case two threads parse the same
+        # file at the same time
+        data = self.loader(path)
+        blob = marshal.dumps(data)
+        entry = {
+            "signature": signature,
+            "blob": blob,
+        }
+
+        with self._lock:
+            self.misses += 1
+            self._remove(path)
+            if len(blob) <= self.max_bytes:
+                self._entries[path] = entry
+                self._bytes += len(blob)
+                self._evict()
+        # The freshly loaded data is not kept, the caller can have it as-is
+        return entry, data
+
+    def _remove(self, path):
+        entry = self._entries.pop(path, None)
+        if entry is not None:
+            self._bytes -= len(entry["blob"])
+
+    def _evict(self):
+        # Drop least recently used entries until under the cap
+        while self._bytes > self.max_bytes and self._entries:
+            path, entry = self._entries.popitem(last=False)
+            self._bytes -= len(entry["blob"])
+
+
+class LocalAddress(object):
+
+    def __init__(self, ttl=300, resolver=None):
+        '''
+        ttl      = seconds a looked up address is used before looking it up
+                   again, 0 looks it up every time
+        resolver = callable() returning the address, defaults to
+                   util.get_preferred_local_ip
+        '''
+        self.ttl = ttl
+        self.resolver = resolver
+        self._lock = threading.Lock()
+        self._address = None
+        self._expires = 0
+        self._override = None
+
+    def get(self):
+        '''
+        Returns the local IP address, looking it up if the cached one expired
+        '''
+        if self._override is not None:
+            return self._override
+        with self._lock:
+            if self._address is None or time.time() >= self._expires:
+                self._lookup()
+            return self._address
+
+    def refresh(self):
+        '''
+        Looks up the address now (e.g. after a network change) and returns it
+        '''
+        with self._lock:
+            self._lookup()
+            return self._address
+
+    def set(self, address):
+        '''
+        Makes get() return address instead of looking it up, for tests and
+        hosts where the lookup picks the wrong interface. None goes back to
+        looking it up.
+        '''
+        self._override = address
+
+    def _lookup(self):
+        resolver = self.resolver or util.get_preferred_local_ip
+        self._address = resolver()
+        self._expires = time.time() + self.ttl
+
+
+def abspath_key(path):
+    return os.path.normcase(os.path.abspath(path))
+
+
+def file_signature(path):
+    '''
+    Returns (mtime, size, inode) of path, which changes whenever the file is
+    modified or replaced
+    '''
+    st = os.stat(path)
+    return (st.st_mtime, st.st_size, st.st_ino)
+
+
+# Caches shared by all JCF objects in this process
+include_cache = ParsedFileCache()
+local_address = LocalAddress()
@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+
+''' ckey_template
+Compiled ckey_template sections.
+
+The ckey_template section holds one template per serial (file), each mapping
+ckey names to settings such as "default", "hidden", "data_type" and "options".
+Jobs built from the same includes carry the same templates, so the templates
+are merged into a DefaultsTable and a TypeTable once per unique ckey_template
+section and the tables are cached for the process.
+
+Applying the table to a ckey section gives the same result as walking the
+templates serial by serial: the first template (in section order) that has a
+default for a missing ckey provides it, "hidden" settings without a default
+are an error if nothing provides a default first, and ckeys with the "list"
+data_type are turned into lists.
+
+The TypeTable checks and converts every ckey that has a supported data_type
+in one pass and reports all bad values at once. Supported data types are
+list, int, bool, string and enum (value must be one of "options"); the
+options of the other types are checked as well. Ckeys without a data_type
+or with another one are not checked. Values still holding ${...} variables
+are left alone since they are only known once interpolated.
+
+Usage:
+compile_defaults(jcf.ckey_template).apply(jcf.ckey, jcf.path)
+compile_types(jcf.ckey_template).apply(jcf.ckey, jcf.path)
+'''
+
+
+import hashlib
+import marshal
+from copy import deepcopy
+
+
+# Upper bound on the number of compiled tables kept, the cache is emptied when
+# it fills up
+CACHE_SIZE = 256
+
+# Strings accepted for the bool data type
+TRUE_STRINGS = ("true", "yes", "on", "1")
+FALSE_STRINGS = ("false", "no", "off", "0")
+
+_table_cache = dict()
+
+
+class DefaultsTable(object):
+    '''
+    The ckey_template section compiled for applying defaults.
+
+    defaults     = ckey name -> default value (already a list if required)
+                   for ckeys that have a default
+    errors       = ckey name -> position of the hidden setting without a
+                   default that fails if the ckey is missing
+    wrap_present = ckey names to be turned into lists if they are set
+    '''
+
+    def __init__(self, ckey_template):
+        self.defaults = dict()
+        self.errors = dict()
+        self.wrap_present = list()
+
+        # ckey name -> True once a default was found for it
+        found = dict()
+        wrap_missing = dict()
+        wrap_present = dict()
+        position = 0
+        for serial in ckey_template:
+            ckeyList = ckey_template[serial]
+            for ct in ckeyList.keys():
+                position += 1
+                setting = ckeyList[ct]
+                if ct not in found:
+                    if "default" in setting:
+                        found[ct] = True
+                        self.defaults[ct] = setting["default"]
+                    elif "hidden" in setting:
+                        self.errors.setdefault(ct, position)
+
+                if setting.get("data_type", "").lower() == "list":
+                    wrap_present[ct] = True
+                    if ct in found:
+                        wrap_missing[ct] = True
+
+        for ct in wrap_missing:
+            if not isinstance(self.defaults[ct], list):
+                self.defaults[ct] = [self.defaults[ct]]
+        self.wrap_present = wrap_present.keys()
+
+    def apply(self, ckey, path=None):
+        '''
+        Inserts the defaults of missing ckeys into the ckey dict and turns
+        expected lists into lists.
+
+        Exceptions:
+            ValueError if a hidden setting is missing and has no default
+        '''
+        errors = [(self.errors[ct], ct) for ct in self.errors
+                  if ct not in ckey]
+        if errors:
+            raise ValueError("JCF " + str(path) +
+                             " hidden ckey_template setting " +
+                             "'{0}' must have a default field".format(
+                                 min(errors)[1]))
+
+        for ct in self.wrap_present:
+            if ct in ckey and not isinstance(ckey[ct], list):
+                ckey[ct] = [ckey[ct]]
+
+        missing = dict()
+        for ct, value in self.defaults.items():
+            if ct not in ckey:
+                # The table is shared, do not hand out its values
+                if isinstance(value, dict) or isinstance(value, list):
+                    value = deepcopy(value)
+                missing[ct] = value
+        ckey.update(missing)
+
+
+class TypeTable(object):
+    '''
+    The ckey_template section compiled for type checking.
+
+    checks = list of (ckey name, coercion function or None, options or None)
+             in template order. The data_type and options of a ckey come from
+             the first template that has them. Ckeys without a data_type or
+             with one that is not supported are not checked at all.
+    '''
+
+    def __init__(self, ckey_template):
+        self.checks = list()
+
+        data_types = dict()
+        options = dict()
+        order = list()
+        seen = set()
+        for serial in ckey_template:
+            ckeyList = ckey_template[serial]
+            for ct in ckeyList.keys():
+                setting = ckeyList[ct]
+                if ct not in seen:
+                    seen.add(ct)
+                    order.append(ct)
+                if ct not in data_types and setting.get("data_type"):
+                    data_types[ct] = setting["data_type"]
+                if ct not in options and "options" in setting:
+                    options[ct] = setting["options"]
+
+        for ct in order:
+            data_type = data_types.get(ct, "").lower()
+            if data_type not in coercions:
+                continue
+            if data_type == "enum" and ct not in options:
+                raise ValueError("ckey_template enum setting '{0}' ".format(ct) +
+                                 "must have an options field")
+            self.checks.append((ct, coercions[data_type], options.get(ct)))
+
+    def check(self, ckey, scope=None):
+        '''
+        Converts the ckeys in place to their data_type and checks them
+        against their options. Returns a list of error messages, one per ckey
+        with a bad value; scope is named in the messages if set.
+        '''
+        errors = list()
+        for ct, coerce, options in self.checks:
+            if ct not in ckey:
+                continue
+            try:
+                ckey[ct] = check_value(ckey[ct], coerce, options)
+            except ValueError as e:
+                if scope:
+                    errors.append("'{0}' (local {1}) {2}".format(ct, scope, e))
+                else:
+                    errors.append("'{0}' {1}".format(ct, e))
+        return errors
+
+    def apply(self, ckey, path=None):
+        '''
+        Same as check() for a single ckey dict.
+
+        Exceptions:
+            ValueError listing every ckey with a bad value
+        '''
+        errors = self.check(ckey)
+        if errors:
+            raise ValueError("JCF " + str(path) + " invalid ckey values: " +
+                             "; ".join(errors))
+
+
+def has_variables(value):
+    return ((isinstance(value, str) or isinstance(value, unicode)) and
+            "${" in value)
+
+
+def check_value(value, coerce, options):
+    '''
+    Returns value converted by coerce, raises ValueError if it cannot be
+    converted or is not one of options
+    '''
+    if has_variables(value):
+        return value
+    if coerce is not None:
+        value = coerce(value)
+    if options is not None:
+        if coerce is to_list:
+            for v in value:
+                if not has_variables(v) and v not in options:
+                    raise ValueError("{0!r} is not one of {1!r}".format(
+                        v, options))
+        elif value not in options:
+            raise ValueError("{0!r} is not one of {1!r}".format(value,
+                                                                options))
+    return value
+
+
+def to_list(value):
+    if isinstance(value, list):
+        return value
+    return [value]
+
+
+def to_int(value):
+    if isinstance(value, bool):
+        raise ValueError("expected int, got {0!r}".format(value))
+    if isinstance(value, int) or isinstance(value, long):
+        return value
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, str) or isinstance(value, unicode):
+        try:
+            return int(value.strip())
+        except ValueError:
+            pass
+    raise ValueError("expected int, got {0!r}".format(value))
+
+
+def to_bool(value):
+    if isinstance(value, bool):
+        return value
+    if (isinstance(value, int) or isinstance(value, long)) and \
+            value in (0, 1):
+        return bool(value)
+    if isinstance(value, str) or isinstance(value, unicode):
+        if value.strip().lower() in TRUE_STRINGS:
+            return True
+        if value.strip().lower() in FALSE_STRINGS:
+            return False
+    raise ValueError("expected bool, got {0!r}".format(value))
+
+
+def to_string(value):
+    if isinstance(value, str) or isinstance(value, unicode):
+        return value
+    if not isinstance(value, bool) and (isinstance(value, int) or
+                                        isinstance(value, long) or
+                                        isinstance(value, float)):
+        return str(value)
+    raise ValueError("expected string, got {0!r}".format(value))
+
+
+# data_type -> coercion function, enum only checks the options
+coercions = {
+    "list": to_list,
+    "int": to_int,
+    "integer": to_int,
+    "bool": to_bool,
+    "boolean": to_bool,
+    "string": to_string,
+    "str": to_string,
+    "enum": None,
+}
+
+
+def compile_table(cls, ckey_template):
+    '''
+    Returns the cls table (DefaultsTable or TypeTable) for a ckey_template
+    section, compiling it only if the same section has not been seen before
+    '''
+    # The section order matters (first template wins), marshal keeps it
+    cache_key = (cls.__name__,
+                 hashlib.sha1(marshal.dumps(ckey_template)).digest())
+    table = _table_cache.get(cache_key)
+    if table is None:
+        table = cls(ckey_template)
+        if len(_table_cache) >= CACHE_SIZE:
+            _table_cache.clear()
+        _table_cache[cache_key] = table
+    return table
+
+
+def compile_defaults(ckey_template):
+    return compile_table(DefaultsTable, ckey_template)
+
+
+def compile_types(ckey_template):
+    return compile_table(TypeTable, ckey_template)
+
+
+def clear_cache():
+    _table_cache.clear()
@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+
+''' interpolate
+Compiled templates for JCF variable interpolation.
+
+A string such as "reboot ${suts.sut.sys_ip} after ${ckey.wait[0]}" is parsed
+once into a sequence of literal text and Variable segments. Each variable path
+is pre-split into a tuple of dict keys and list indexes so it can be walked
+directly against the JCF sections instead of being turned into Python source
+and eval'ed.
+
+Compiled templates are cached by (filter, string) so the same text found in
+many stages is only parsed once per process.
+
+DependencyIndex remembers where each template came from and which variable
+paths it depends on (collected by a LookupRecorder) so only the affected
+strings are interpolated again after a change.
+
+Usage:
+template = compile_template(string)
+for segment in template.segments:
+    ...
+'''
+
+
+import re
+
+
+# Variable syntax, filter is prepended to the key part of the expression
+VAR_TEMPLATE = r'(\$\{(%s[- \w\s\.\:\[\]]+)\})'
+
+# Array reference at the end of a key part: key[#]
+INDEX_RE = re.compile(r'(.+?)(\[\d+\])$')
+
+# Upper bound on the number of templates held in the cache. The cache is
+# simply emptied when it fills up; job files tend to repeat the same strings
+# so it refills with the hot entries quickly.
+CACHE_SIZE = 50000
+
+_var_res = dict()
+_template_cache = dict()
+
+
+class Variable(object):
+    '''
+    One ${...} reference within a template.
+
+    text      = the full variable text, e.g. "${ckey.wait}"
+    key       = the text between the braces, e.g. "ckey.wait"
+    path      = key split into dict keys and list indexes,
+                e.g. "info.list[1]" -> ("info", "list", 1)
+    ckey_name = for ${ckey.X...} variables the raw "X" part used to redirect
+                lookups into the local section, otherwise None
+    '''
+    __slots__ = ("text", "key", "path", "ckey_name")
+
+    def __init__(self, text, key):
+        self.text = text
+        self.key = key
+        key_parts = key.split(".")
+        self.path = parse_path(key_parts)
+        if len(key_parts) > 1 and key_parts[0] == "ckey":
+            self.ckey_name = key_parts[1]
+        else:
+            self.ckey_name = None
+
+    def __repr__(self):
+        return "<Variable " + self.text + ">"
+
+
+class Template(object):
+    '''
+    A parsed string.
+
+    segments = list of literal strings and Variable objects in the order they
+               appear in the source string
+    single   = True if the whole string is exactly one variable, in which case
+               the variable may resolve to a structure instead of a string
+    '''
+    __slots__ = ("source", "segments", "variables", "single")
+
+    def __init__(self, source, segments):
+        self.source = source
+        self.segments = segments
+        self.variables = [s for s in segments if isinstance(s, Variable)]
+        self.single = (len(segments) == 1 and bool(self.variables))
+
+    def __repr__(self):
+        return "<Template " + repr(self.source) + ">"
+
+
+def parse_path(key_parts):
+    '''
+    Turns ["path1", "path2[0]", "key"] into ("path1", "path2", 0, "key")
+    '''
+    path = list()
+    for kp in key_parts:
+        m = INDEX_RE.search(kp)
+        if m:
+            # array form: key[#]
+            path.append(m.group(1))
+            path.append(int(m.group(2)[1:-1]))
+        else:
+            path.append(kp)
+    return tuple(path)
+
+
+def var_re(filter=""):
+    '''
+    Returns the compiled variable expression for a given filter
+    '''
+    r = _var_res.get(filter)
+    if r is None:
+        r = _var_res[filter] = re.compile(VAR_TEMPLATE % filter)
+    return r
+
+
+def compile_template(string, filter=""):
+    '''
+    Parses string into a Template, returning a cached copy if this exact
+    string has been compiled before with the same filter.
+    '''
+    cache_key = (filter, string)
+    template = _template_cache.get(cache_key)
+    if template is not None:
+        return template
+
+    segments = list()
+    variables = dict()
+    pos = 0
+    for m in var_re(filter).finditer(string):
+        if m.start() > pos:
+            segments.append(string[pos:m.start()])
+        text, key = m.groups()
+        # Share Variable objects for repeated references in the same string
+        if key not in variables:
+            variables[key] = Variable(text, key)
+        segments.append(variables[key])
+        pos = m.end()
+    if pos < len(string):
+        segments.append(string[pos:])
+
+    template = Template(string, segments)
+    if len(_template_cache) >= CACHE_SIZE:
+        _template_cache.clear()
+    _template_cache[cache_key] = template
+    return template
+
+
+def lookup(data, path):
+    '''
+    Walks data following path (as returned by parse_path). Returns a tuple
+    (found, value); found is False if any step of the path does not exist.
+    '''
+    try:
+        for p in path:
+            data = data[p]
+    except Exception:
+        return False, None
+    return True, data
+
+
+class LookupRecorder(object):
+    '''
+    Collects the paths looked up while one tracked string is interpolated,
+    see DependencyIndex.
+
+    index    = the DependencyIndex the string belongs to
+    position = if set, strings of leaves at this position or after it are
+               seen as their original string, as they are when all sections
+               are interpolated one string after the other
+    '''
+    __slots__ = ("index", "position", "paths")
+
+    def __init__(self, index, position=None):
+        self.index = index
+        self.position = position
+        self.paths = list()
+
+    def lookup(self, lookup_path, path):
+        '''
+        Returns (found, value) for path, using lookup_path(path) for anything
+        that is not the original string of a leaf
+        '''
+        self.paths.append(path)
+        if self.position is not None:
+            leaves = self.index.leaves
+            positions = self.index.positions
+            for i in range(2, len(path) + 1):
+                location = path[:i]
+                if location in leaves and positions[location] >= self.position:
+                    return lookup(leaves[location][0], path[i:])
+        return lookup_path(path)
+
+
+class DependencyIndex(object):
+    '''
+    Change tracking for interpolated strings.
+
+    A leaf is a string within the JCF that contained variables, identified by
+    its location: the keys/indexes leading to it from the top of the JCF, e.g.
+    ("stages", "install", "action", "p"). For each leaf the original string,
+    the scope it was interpolated in, its position in the order the sections
+    are interpolated and the variable paths it depends on (including those
+    reached through nested variables) are kept.
+
+    dependents() then answers which leaves have to be interpolated again when
+    the values at some paths change.
+
+    scope    = default scope the sections were interpolated with
+    filter   = filter the sections were interpolated with
+    sections = sections that were interpolated
+    '''
+
+    def __init__(self, scope=None, filter="", sections=None):
+        self.scope = scope
+        self.filter = filter
+        self.sections = sections or []
+        # location -> (source string, scope)
+        self.leaves = dict()
+        # location -> (rank of its section, order the leaf was added in), a
+        # leaf added later comes after the other leaves of its section
+        self.positions = dict()
+        self._position = 0
+        self._ranks = dict((s, i) for i, s in enumerate(self.sections))
+        # location -> list of dependency paths
+        self.deps = dict()
+        # location -> variables that could not be found
+        self.errors = dict()
+        # location of a sut id or name -> the list that was replaced by its
+        # first element
+        self.sut_lists = dict()
+        # dependency path -> set of locations
+        self._by_dep = dict()
+        # prefix of a dependency path -> set of locations
+        self._by_dep_prefix = dict()
+        # prefix of a location -> set of locations
+        self._by_location_prefix = dict()
+
+    def add(self, location, source, scope):
+        if location in self.leaves:
+            self.remove(location)
+        self.leaves[location] = (source, scope)
+        self.positions[location] = (self._ranks.get(location[0], -1),
+                                    self._position)
+        self._position += 1
+        for i in range(1, len(location) + 1):
+            self._by_location_prefix.setdefault(location[:i], set()).add(location)
+
+    def set_dependencies(self, location, paths):
+        paths = list(set(paths))
+        for path in self.deps.get(location, []):
+            self._discard(self._by_dep, path, location)
+            for i in range(1, len(path) + 1):
+                self._discard(self._by_dep_prefix, path[:i], location)
+
+        self.deps[location] = paths
+        for path in paths:
+            self._by_dep.setdefault(path, set()).add(location)
+            for i in range(1, len(path) + 1):
+                self._by_dep_prefix.setdefault(path[:i], set()).add(location)
+
+    def remove(self, location):
+        if location not in self.leaves:
+            return
+        self.set_dependencies(location, [])
+        del self.deps[location]
+        del self.leaves[location]
+        del self.positions[location]
+        self.errors.pop(location, None)
+        for i in range(1, len(location) + 1):
+            self._discard(self._by_location_prefix, location[:i], location)
+
+    def remove_under(self, prefix):
+        '''
+        Forgets every leaf at or below prefix, returns their locations
+        '''
+        removed = list(self._by_location_prefix.get(prefix, ()))
+        for location in removed:
+            self.remove(location)
+        for location in self.sut_lists.keys():
+            if location[:len(prefix)] == prefix:
+                del self.sut_lists[location]
+        return removed
+
+    def source(self, location):
+        '''
+        Returns the original string of the leaf at location or None
+        '''
+        leaf = self.leaves.get(location)
+        if leaf is None:
+            return None
+        return leaf[0]
+
+    def dependents(self, paths):
+        '''
+        Returns the set of leaf locations that depend on any of the given
+        paths. A leaf depends on a path if it referenced the path itself,
+        something below it or a structure containing it.
+        '''
+        found = set()
+        for path in paths:
+            found.update(self._by_dep_prefix.get(path, ()))
+            for i in range(1, len(path)):
+                found.update(self._by_dep.get(path[:i], ()))
+        return found
+
+    def _discard(self, index, key, location):
+        locations = index.get(key)
+        if locations is not None:
+            locations.discard(location)
+            if not locations:
+                del index[key]
+
+
+def clear_cache():
+    _template_cache.clear()
@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+
+''' jsonio
+JSON input and output for JCF and status files.
+
+write_json() encodes data piece by piece straight into the output file instead
+of building the whole document as one string first, so saving a large job
+does not need memory for a second copy of it. The data is written to a
+temporary file next to the target which is then renamed over it; readers see
+either the old or the new file, never a partly written one. The new file keeps
+the mode and owner of the old one, and a symlinked target is written through
+the link. Pretty (default) output uses the same format settings as
+util.write_json (PRETTY_FORMAT) so files look the same as they always have.
+
+Parsing goes through a codec. The default is the fastest JSON library that
+is installed and gives the same results as util.read_json_str (currently
+ujson), otherwise the standard library is used through util.read_json. Set
+the CIRRUS_JSON_CODEC environment variable or call set_codec() to choose one
+explicitly. Documents a fast codec cannot parse (e.g. very large integers)
+are handed to the standard library so results and errors stay the same.
+Output is always encoded by the standard library.
+
+Usage:
+data = read_json(path)
+write_json(path, data)
+write_json(path, data, compact=True)
+set_codec("stdlib")
+'''
+
+
+import json
+import os
+import shutil
+import stat
+import threading
+
+from .. import util
+
+
+# Output is collected into chunks of about this many characters before being
+# written to the file
+CHUNK_SIZE = 64 * 1024
+
+# Encoder settings of pretty output, the same as util.write_json
+PRETTY_FORMAT = {
+    "indent": 4,
+    "sort_keys": True,
+    "separators": (',', ': ')
+}
+
+_tmp_counter = [0]
+_tmp_lock = threading.Lock()
+
+
+class Codec(object):
+    '''
+    A JSON library.
+
+    name  = name used to select the codec
+    loads = callable(string) returning the parsed data
+    '''
+
+    def __init__(self, name, loads):
+        self.name = name
+        self.loads = loads
+
+
+def _stdlib_codec():
+    return Codec("stdlib", util.read_json_str)
+
+
+def _ujson_codec():
+    import ujson
+
+    def loads(s):
+        try:
+            return ujson.loads(s, precise_float=True)
+        except TypeError:
+            # Newer versions always parse floats precisely
+            return ujson.loads(s)
+
+    # Sanity check against the standard library codec: types of strings
+    # and numbers, float precision and nesting must come out the same
+    sample = '{"a": ["\\u00e9", "b", 0.1, 1e-07, 1.7976931348623157e+308, ' \
+             '-0.0, 10, true, null, {"c": {}}]}'
+    try:
+        same = repr(loads(sample)) == repr(util.read_json_str(sample))
+    except (ValueError, OverflowError, TypeError):
+        same = False
+    if not same:
+        raise ImportError("ujson does not parse like util.read_json_str")
+
+    # Encoding stays with the json module, ujson rounds floats
+    return Codec("ujson", loads)
+
+
+# Codecs in order of preference
+codecs = [
+    ("ujson", _ujson_codec),
+    ("stdlib", _stdlib_codec),
+]
+
+_codec = [None]
+
+
+def set_codec(name=None):
+    '''
+    Selects the codec by name, None picks the first one available
+    '''
+    for n, factory in codecs:
+        if name is not None and n != name:
+            continue
+        try:
+            _codec[0] = factory()
+            return _codec[0]
+        except ImportError:
+            if name is not None:
+                raise ValueError("JSON codec " + name + " is not available")
+    raise ValueError("Unknown JSON codec " + str(name))
+
+
+def get_codec():
+    if _codec[0] is None:
+        set_codec(os.environ.get("CIRRUS_JSON_CODEC") or None)
+    return _codec[0]
+
+
+def read_json_str(s):
+    '''
+    Parses the JSON string s
+    '''
+    codec = get_codec()
+    if codec.name == "stdlib":
+        return util.read_json_str(s)
+    try:
+        return codec.loads(s)
+    except (ValueError, OverflowError):
+        return util.read_json_str(s)
+
+
+def read_json(path):
+    '''
+    Parses the JSON file at path
+    '''
+    codec = get_codec()
+    if codec.name == "stdlib":
+        return util.read_json(path)
+    with open(path, "rb") as f:
+        s = f.read()
+    try:
+        return codec.loads(s)
+    except (ValueError, OverflowError):
+        return util.read_json(path)
+
+
+def encoder(compact=False):
+    '''
+    Returns the encoder for pretty (default) or compact output
+    '''
+    if compact:
+        return json.JSONEncoder(separators=(',', ':'))
+    return json.JSONEncoder(**PRETTY_FORMAT)
+
+
+def dump(data, fp, compact=False):
+    '''
+    Encodes data into the file object fp
+    '''
+    chunk = list()
+    size = 0
+    for s in encoder(compact).iterencode(data):
+        chunk.append(s)
+        size += len(s)
+        if size >= CHUNK_SIZE:
+            fp.write("".join(chunk))
+            chunk = list()
+            size = 0
+    if chunk:
+        fp.write("".join(chunk))
+
+
+def write_json(path, data, compact=False):
+    '''
+    Atomically replaces the file at path with data encoded as JSON
+    '''
+    with atomic_file(path) as fp:
+        dump(data, fp, compact)
+
+
+def copy_file(src, dst):
+    '''
+    Atomically replaces the file at dst with a copy of src
+    '''
+    with atomic_file(dst) as fp:
+        with open(src, "rb") as f:
+            shutil.copyfileobj(f, fp)
+
+
+class atomic_file(object):
+    '''
+    Context manager returning a file object for a temporary file next to
+    path, which replaces path when the block completes without an exception
+    and is removed otherwise.
+
+    A symlink at path is followed, the file it points to is replaced. The
+    new file gets the mode and, where permitted, the owner of the file it
+    replaces.
+    '''
+
+    def __init__(self, path):
+        self.path = os.path.realpath(path)
+        with _tmp_lock:
+            _tmp_counter[0] += 1
+            n = _tmp_counter[0]
+        self.tmp_path = self.path + ".tmp" + str(os.getpid()) + "_" + str(n)
+        self.fp = None
+
+    def __enter__(self):
+        self.fp = open(self.tmp_path, "wb")
+        try:
+            self._copy_metadata()
+        except:
+            self.fp.close()
+            os.remove(self.tmp_path)
+            raise
+        return self.fp
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.fp.close()
+        if exc_type is not None:
+            try:
+                os.remove(self.tmp_path)
+            except OSError:
+                pass
+            return False
+
+        try:
+            os.rename(self.tmp_path, self.path)
+        except OSError:
+            # Windows does not rename over an existing file
+            if os.name != "nt" or not os.path.exists(self.path):
+                os.remove(self.tmp_path)
+                raise
+            os.remove(self.path)
+            os.rename(self.tmp_path, self.path)
+        return False
+
+    def _copy_metadata(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            # New file, keep the defaults
+            return
+        os.chmod(self.tmp_path, stat.S_IMODE(st.st_mode))
+        if hasattr(os, "chown"):
+            try:
+                os.chown(self.tmp_path, st.st_uid, st.st_gid)
+            except OSError:
+                # Only root can give a file away
+                pass